@@ -6,14 +6,23 @@ import argparse
 import codecs
 import logging
 import time
+import hashlib
 
+import numpy
 from annoy import AnnoyIndex
 
+import bin_join
+import docvec_format
+import ordered_pool
+
 
 logger_freq = 2
 logger_timestamp = time.time()
 logger = logging.getLogger(__file__)
 
+annoy_metric = 'angular'
+worker_settings = None
+
 def log_major(message):
 	global logger_timestamp
 	
@@ -29,99 +38,262 @@ def log_minor(message, major=True):
 	logger.info(message)
 	logger_timestamp = time.time()
 
-def docvec_file_bin_iter(doc_file):
-	bin_, docvecs = None, None
+def open_docvec_file(docvec_path):
+	# Both binary and text docvec files are accepted, the format is detected.
+	if docvec_format.is_binary(docvec_path):
+		docvec_file = open(docvec_path, "rb")
+		return (docvec_file, docvec_format.bin_iter(docvec_file))
 
-	for line in doc_file:
-		
-		tokens = line.strip().split("\t")
+	docvec_file = codecs.open(docvec_path, "r", "utf-8")
+	return (docvec_file, docvec_format.text_bin_iter(docvec_file))
 
-		doc_bin = tokens[0]
-		doc_id = tokens[1]
-		docvec_str = tokens[2].split()
-		docvec = map(float,docvec_str)
+def build_index(trg_doc_ids, trg_docvecs, n_trees, n_jobs):
+	annoy = AnnoyIndex(trg_docvecs.shape[1], metric=annoy_metric)
 
-		if doc_bin != bin_:
-			if bin_: yield (bin_, docvecs)
-			bin_, docvecs = doc_bin, []
-			
-		docvecs.append((doc_id, docvec))
+	# Annoy assumes that items are indexed from 0 to (n-1).
+	# https://github.com/spotify/annoy#python-code-example
 
-	if bin_: yield (bin_, docvecs)
+	trg_doc_id_map = list(trg_doc_ids)
+	for new_trg_doc_id, trg_docvec in enumerate(trg_docvecs.tolist()):
+		annoy.add_item(new_trg_doc_id, trg_docvec)
 
-def align_docvec(src_docvec_file, trg_docvec_file, ann, n_trees, search_k, output_file):
-	# Annoy homepage and API documentation.
+	# Annoy builds the trees of a single index in several threads.
 	# https://github.com/spotify/annoy#full-python-api
+	annoy.build(n_trees, n_jobs=n_jobs)
+	return (annoy, trg_doc_id_map)
 
-	# Tradeoff choosing settings for the search_k.
-	# https://github.com/spotify/annoy#tradeoffs
-	if not search_k: search_k = ann * n_trees * 2
+def index_cache_key(trg_doc_ids, trg_docvecs, n_trees):
+	# Annoy stores the items as float32, hence the docvecs are hashed as such.
+	content_hash = hashlib.sha1()
+	content_hash.update(numpy.ascontiguousarray(trg_docvecs, dtype=numpy.float32).tobytes())
+	content_hash.update("\n".join(trg_doc_ids).encode("utf-8"))
 
-	log_major("Aligning bins ...")
+	return "%s_%s_%s" % (content_hash.hexdigest(), n_trees, annoy_metric)
+
+def load_index(index_cache, trg_doc_ids, trg_docvecs, n_trees, n_jobs):
+	if not index_cache: return build_index(trg_doc_ids, trg_docvecs, n_trees, n_jobs)
+
+	cache_key = index_cache_key(trg_doc_ids, trg_docvecs, n_trees)
+	index_path = os.path.join(index_cache, "%s.ann" % cache_key)
+	ids_path = os.path.join(index_cache, "%s.ids" % cache_key)
+
+	if os.path.isfile(index_path) and os.path.isfile(ids_path):
+		log_major("Loading cached index %s ..." % cache_key)
+
+		# Loading memory-maps the index file, it is not read in whole.
+		annoy = AnnoyIndex(trg_docvecs.shape[1], metric=annoy_metric)
+		annoy.load(index_path)
+
+		ids_file = codecs.open(ids_path, "r", "utf-8")
+		trg_doc_id_map = ids_file.read().split("\n")
+		ids_file.close()
+
+		return (annoy, trg_doc_id_map)
+
+	annoy, trg_doc_id_map = build_index(trg_doc_ids, trg_docvecs, n_trees, n_jobs)
+
+	log_major("Caching index %s ..." % cache_key)
+
+	# Files are renamed into place only once they are complete, so that an
+	# interrupted run does not leave a broken index in the cache. The index
+	# file is renamed last, because its presence marks a valid cache entry.
+	temp_suffix = ".%s.tmp" % os.getpid()
+
+	ids_file = codecs.open(ids_path + temp_suffix, "w", "utf-8")
+	ids_file.write("\n".join(trg_doc_id_map))
+	ids_file.close()
+	os.rename(ids_path + temp_suffix, ids_path)
+
+	annoy.save(index_path + temp_suffix)
+	os.rename(index_path + temp_suffix, index_path)
+
+	return (annoy, trg_doc_id_map)
+
+def matched_bin_iter(src_bin_iter, trg_bin_iter):
+	for bin_, (load_src_bin, load_trg_bin) in bin_join.join_bins(src_bin_iter, trg_bin_iter):
+
+		src_doc_ids, src_docvecs = load_src_bin()
+		trg_doc_ids, trg_docvecs = load_trg_bin()
+
+		yield (bin_, src_doc_ids, src_docvecs, trg_doc_ids, trg_docvecs)
+
+def init_worker(settings):
+	global worker_settings
+	worker_settings = settings
+
+def query_annoy(bin_, src_docvecs, trg_doc_ids, trg_docvecs):
+	ann, search_k = worker_settings["ann"], worker_settings["search_k"]
+
+	annoy, trg_doc_id_map = load_index(worker_settings["index_cache"],
+		trg_doc_ids, trg_docvecs, worker_settings["n_trees"], worker_settings["n_jobs"])
+
+	for src_docvec in src_docvecs.tolist():
+
+		trg_neighbours = annoy.get_nns_by_vector(src_docvec, 
+			ann, search_k=search_k, include_distances=True)
+
+		nn_doc_ids = [trg_doc_id_map[x] for x in trg_neighbours[0]]
+		cosine_sims = [(1 - (x / 2.)) for x in trg_neighbours[1]]
+		yield (nn_doc_ids, cosine_sims)
+
+def normalize_docvecs(docvecs):
+	docvecs = numpy.asarray(docvecs, dtype=numpy.float32)
+	norms = numpy.sqrt((docvecs ** 2).sum(axis=1))
+	norms[norms == 0] = 1.
+
+	return docvecs / norms[:, numpy.newaxis]
+
+def query_exact(bin_, src_docvecs, trg_doc_ids, trg_docvecs):
+	# Exact search compares all the pairs with blocked matrix products.
+	# The block size bounds the memory taken by the similarity matrix.
+	ann, block_cells = worker_settings["ann"], 2 ** 24
 
-	src_bin_iter = docvec_file_bin_iter(src_docvec_file)
-	trg_bin_iter = docvec_file_bin_iter(trg_docvec_file)
-	src_item, trg_item = None, None 
+	src_units = normalize_docvecs(src_docvecs)
+	trg_units = normalize_docvecs(trg_docvecs)
 
-	src_docvec_index = 0
-	while True:
+	nn_count = min(ann, len(trg_doc_ids))
+	block_size = max(1, block_cells // len(trg_doc_ids))
 
-		if not src_item: src_item = next(src_bin_iter, None)
-		if not trg_item: trg_item = next(trg_bin_iter, None)
-		if not src_item or not trg_item: break
+	for block_start in range(0, len(src_units), block_size):
 
-		src_bin, src_docvecs = src_item
-		trg_bin, trg_docvecs = trg_item
+		cosines = src_units[block_start:block_start + block_size].dot(trg_units.T)
+		block_rows = numpy.arange(len(cosines))[:, numpy.newaxis]
 
-		if src_bin < trg_bin: src_item = None
-		if trg_bin < src_bin: trg_item = None
-		if src_bin != trg_bin: continue
+		nn_indices = numpy.argpartition(-cosines, nn_count - 1, axis=1)[:, :nn_count]
+		nn_order = numpy.argsort(-cosines[block_rows, nn_indices], axis=1, kind="mergesort")
+		nn_indices = nn_indices[block_rows, nn_order]
 
-		log_major("Aligning bin '%s' ..." % src_bin)
-		log_major("Collecting target docvecs ...")
+		# The angular distance of Annoy is used, so that the scores
+		# of both backends are comparable with each other.
+		nn_distances = numpy.sqrt(numpy.maximum(2. - 2. * cosines[block_rows, nn_indices], 0.))
 
-		docvec_length = len(trg_docvecs[0][1])
-		annoy = AnnoyIndex(docvec_length, metric='angular')
+		for indices, distances in zip(nn_indices.tolist(), nn_distances.tolist()):
 
-		# Annoy assumes that items are indexed from 0 to (n-1).
-		# https://github.com/spotify/annoy#python-code-example
-		
-		new_trg_doc_id = 0
-		trg_doc_id_map = {}
-		for trg_doc_id, trg_docvec in trg_docvecs:
+			nn_doc_ids = [trg_doc_ids[x] for x in indices]
+			cosine_sims = [(1 - (x / 2.)) for x in distances]
+			yield (nn_doc_ids, cosine_sims)
 
-			trg_doc_id_map[new_trg_doc_id] = trg_doc_id
-			annoy.add_item(new_trg_doc_id, trg_docvec)
-			new_trg_doc_id += 1
+def lsh_signatures(units, hyperplanes):
+	# Every bit tells on which side of a random hyperplane the docvec lies.
+	# The bits of each table are packed into a single uint64 signature.
+	table_count, bit_count, docvec_length = hyperplanes.shape
 
-		log_major("Target docvecs collected.")
-		log_major("Indexing target docvecs ...")
+	projections = units.dot(hyperplanes.reshape((table_count * bit_count, docvec_length)).T)
+	bits = (projections >= 0).reshape((len(units), table_count, bit_count)).astype(numpy.uint64)
 
-		annoy.build(n_trees)
+	bit_values = numpy.left_shift(numpy.uint64(1), numpy.arange(bit_count, dtype=numpy.uint64))
+	return (bits * bit_values).sum(axis=2, dtype=numpy.uint64)
 
-		log_major("Target docvecs indexed.")
-		log_major("Querying source docvecs ...")
+def query_lsh(bin_, src_docvecs, trg_doc_ids, trg_docvecs):
+	# Random hyperplane locality-sensitive hashing for the cosine similarity.
+	# http://www.cs.princeton.edu/courses/archive/spr04/cos598B/bib/CharikarEstim.pdf
 
-		for src_doc_id, src_docvec in src_docvecs:
+	# Candidates share a bucket with the query in at least one table and
+	# they are reranked by the exact cosine similarity. More bits make the
+	# buckets smaller and faster, more tables make the recall higher.
+	ann = worker_settings["ann"]
+	table_count, bit_count = worker_settings["lsh_tables"], worker_settings["lsh_bits"]
 
-			src_docvec_index += 1
-			log_minor("Querying source docvec %s." % src_docvec_index)
+	src_units = normalize_docvecs(src_docvecs)
+	trg_units = normalize_docvecs(trg_docvecs)
 
-			trg_neighbours = annoy.get_nns_by_vector(src_docvec, 
-				ann, search_k=search_k, include_distances=True)
+	random_state = numpy.random.RandomState(worker_settings["lsh_seed"])
+	hyperplanes = random_state.normal(size=(table_count, bit_count, trg_units.shape[1]))
+	hyperplanes = hyperplanes.astype(numpy.float32)
+
+	src_signatures = lsh_signatures(src_units, hyperplanes)
+	trg_signatures = lsh_signatures(trg_units, hyperplanes)
+
+	# Buckets are contiguous ranges of the targets sorted by the signature.
+	trg_orders = numpy.argsort(trg_signatures, axis=0, kind="mergesort")
+	bucket_starts, bucket_ends = [], []
+	for table in range(table_count):
+
+		sorted_signatures = trg_signatures[trg_orders[:, table], table]
+		bucket_starts.append(numpy.searchsorted(sorted_signatures, src_signatures[:, table], side="left"))
+		bucket_ends.append(numpy.searchsorted(sorted_signatures, src_signatures[:, table], side="right"))
+
+	for src_index in range(len(src_units)):
+
+		candidates = [trg_orders[bucket_starts[table][src_index]:bucket_ends[table][src_index], table]
+			for table in range(table_count)]
+		candidates = numpy.unique(numpy.concatenate(candidates))
+
+		cosines = trg_units[candidates].dot(src_units[src_index])
+		nn_count = min(ann, len(candidates))
+		if nn_count == 0:
+			yield ([], [])
+			continue
+
+		nn_order = numpy.argpartition(-cosines, nn_count - 1)[:nn_count]
+		nn_order = nn_order[numpy.argsort(-cosines[nn_order], kind="mergesort")]
+		nn_distances = numpy.sqrt(numpy.maximum(2. - 2. * cosines[nn_order], 0.))
+
+		nn_doc_ids = [trg_doc_ids[x] for x in candidates[nn_order].tolist()]
+		cosine_sims = [(1 - (x / 2.)) for x in nn_distances.tolist()]
+		yield (nn_doc_ids, cosine_sims)
+
+backends = {"annoy": query_annoy, "exact": query_exact, "lsh": query_lsh}
+
+def select_backend(trg_doc_ids):
+	backend = worker_settings["backend"]
+	if backend != "auto": return backend
+
+	# Building an index does not pay off for small bins.
+	return "exact" if len(trg_doc_ids) <= worker_settings["exact_size"] else "annoy"
+
+def align_bin(bin_item):
+	bin_, src_doc_ids, src_docvecs, trg_doc_ids, trg_docvecs = bin_item
+	backend = select_backend(trg_doc_ids)
+
+	log_major("Querying source docvecs of bin '%s' (%s) ..." % (bin_, backend))
+
+	neighbours = backends[backend](bin_, src_docvecs, trg_doc_ids, trg_docvecs)
+
+	output_rows = []
+	for src_doc_index, (src_doc_id, (nn_doc_ids, cosine_sims)) in enumerate(zip(src_doc_ids, neighbours)):
+
+		log_minor("Querying source docvec %s of bin '%s'." % (src_doc_index + 1, bin_))
+
+		for trg_doc_id, cosine_sim in zip(nn_doc_ids, cosine_sims):
+			output_rows.append((bin_, src_doc_id, trg_doc_id, cosine_sim))
+
+	return (bin_, output_rows)
+
+def aligned_bin_iter(src_bin_iter, trg_bin_iter, settings, workers):
+	bin_items = matched_bin_iter(src_bin_iter, trg_bin_iter)
+	return ordered_pool.ordered_map(align_bin, bin_items, workers, init_worker, (settings,))
+
+def align_docvec(src_bin_iter, trg_bin_iter, ann, backend, exact_size, n_trees, search_k, index_cache, 
+	lsh_tables, lsh_bits, lsh_seed, workers, n_jobs, output_file):
+	# Annoy homepage and API documentation.
+	# https://github.com/spotify/annoy#full-python-api
+
+	# Tradeoff choosing settings for the search_k.
+	# https://github.com/spotify/annoy#tradeoffs
+	if not search_k: search_k = ann * n_trees * 2
+
+	# A single process builds an index with all the cores by default,
+	# while several processes build one index each with a single core.
+	if not n_jobs: n_jobs = -1 if workers <= 1 else 1
+
+	if index_cache and not os.path.isdir(index_cache): os.makedirs(index_cache)
+	if not 0 < lsh_bits <= 64: raise ValueError("LSH signatures hold 1 to 64 bits.")
+
+	settings = {"ann": ann, "backend": backend, "exact_size": exact_size, 
+		"n_trees": n_trees, "search_k": search_k, "index_cache": index_cache, "n_jobs": n_jobs,
+		"lsh_tables": lsh_tables, "lsh_bits": lsh_bits, "lsh_seed": lsh_seed}
+
+	log_major("Aligning bins ...")
 
-			trg_doc_ids = [trg_doc_id_map[x] for x in trg_neighbours[0]]
-			cosine_sims = [(1 - (x / 2.)) for x in trg_neighbours[1]]
+	for bin_, output_rows in aligned_bin_iter(src_bin_iter, trg_bin_iter, settings, workers):
 
-			for trg_doc_id, cosine_sim in zip(trg_doc_ids, cosine_sims):
-				
-				output_row = "\t".join(map(str, (src_bin, src_doc_id, trg_doc_id, cosine_sim)))
-				output_file.write("%s\n" % output_row)
+		for output_row in output_rows:
 
-		log_major("Source docvecs queried.")
-		log_major("Bin '%s' aligned." % src_bin)
+			output_row = "\t".join(map(str, output_row))
+			output_file.write("%s\n" % output_row)
 
-		src_item, trg_item = None, None
+		log_major("Bin '%s' aligned." % bin_)
 
 	log_major("All bins aligned.")
 
@@ -134,21 +306,30 @@ if __name__ == "__main__":
 	parser.add_argument('-s', '--src_docvec', required=True, type=str)
 	parser.add_argument('-t', '--trg_docvec', required=True, type=str)
 	parser.add_argument('-n', '--ann', type=int, default=10)
+	parser.add_argument('-b', '--backend', choices=['auto', 'annoy', 'exact', 'lsh'], default='auto')
+	parser.add_argument('-es', '--exact_size', type=int, default=2000)
 	parser.add_argument('-nt', '--n_trees', type=int, default=500)
 	parser.add_argument('-sk', '--search_k', type=int, default=None)
+	parser.add_argument('-c', '--cache', type=str, default=None)
+	parser.add_argument('-lt', '--lsh_tables', type=int, default=16)
+	parser.add_argument('-lb', '--lsh_bits', type=int, default=8)
+	parser.add_argument('-ls', '--lsh_seed', type=int, default=1)
+	parser.add_argument('-p', '--workers', type=int, default=1)
+	parser.add_argument('-nj', '--n_jobs', type=int, default=None)
 	parser.add_argument('-o', '--output', required=True, type=str)
 	args = parser.parse_args()
 
 	log_major("Starting execution in %s." % os.getcwd())
 	for arg in vars(args): log_major("Option --%s = %s." % (arg, getattr(args, arg)))
 
-	src_docvec_file = codecs.open(args.src_docvec, "r", "utf-8")
-	trg_docvec_file = codecs.open(args.trg_docvec, "r", "utf-8")
+	src_docvec_file, src_bin_iter = open_docvec_file(args.src_docvec)
+	trg_docvec_file, trg_bin_iter = open_docvec_file(args.trg_docvec)
 	output_file = codecs.open(args.output, "w", "utf-8")
 
 	try:
-		align_docvec(src_docvec_file, trg_docvec_file, 
-			args.ann, args.n_trees, args.search_k, output_file)
+		align_docvec(src_bin_iter, trg_bin_iter, 
+			args.ann, args.backend, args.exact_size, args.n_trees, args.search_k, args.cache, 
+			args.lsh_tables, args.lsh_bits, args.lsh_seed, args.workers, args.n_jobs, output_file)
 
 		log_major("Script ended successfully.")
 	except:
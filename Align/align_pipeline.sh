@@ -6,6 +6,11 @@ PWD=$(pwd)
 SCRIPT=$(basename $0)
 SCRIPT_DIR=$(dirname $0)
 TOOLS_DIR="$SCRIPT_DIR"
+WORKERS=$(nproc)
+
+# Bins of at most this many target docvecs are searched exactly, larger
+# ones, e.g. the 50k-document CzEng bins, go through the Annoy indexes.
+EXACT_SIZE=2000
 
 CZENG_TOKEN_ON=0
 CZENG_LEMMA_ON=0
@@ -14,6 +19,8 @@ CC_LEMMA_ON=0
 
 PREPARE_CZENG="$SCRIPT_DIR"/prepare_czeng.sh
 PREPARE_CC="$SCRIPT_DIR"/prepare_cc.sh
+CONVERT_WORDVEC="$SCRIPT_DIR"/convert_wordvec.py
+CONVERT_WEIGHT="$SCRIPT_DIR"/convert_weight.py
 CREATE_DOCVEC="$SCRIPT_DIR"/create_docvec.py
 ALIGN_DOCVEC="$SCRIPT_DIR"/align_docvec.py
 BENCH_ALIGN="$SCRIPT_DIR"/bench_align.py
@@ -94,10 +101,13 @@ cd $PWD
 if [ $CZENG_TOKEN_ON -eq 1 ]; then
   # NOTE: Processing tokenized CzEng head.
   execute $PREPARE_CZENG -c $CZENG_TOKEN_HEAD_FILE -cs czeng_token_head_doc_cs -en czeng_token_head_doc_en -b 50000
-  execute $CREATE_DOCVEC -d czeng_token_head_doc_cs -w $CZENG_TOKEN_WORDVEC_CS_FILE -o czeng_token_head_docvec_cs
-  execute $CREATE_DOCVEC -d czeng_token_head_doc_en -w $CZENG_TOKEN_WORDVEC_EN_FILE -o czeng_token_head_docvec_en
+  execute $CONVERT_WORDVEC -w $CZENG_TOKEN_WORDVEC_CS_FILE
+  execute $CONVERT_WORDVEC -w $CZENG_TOKEN_WORDVEC_EN_FILE
+  execute $CONVERT_WEIGHT -w $CZENG_TOKEN_WEIGHT_FILE
+  execute $CREATE_DOCVEC -d czeng_token_head_doc_cs -w $CZENG_TOKEN_WORDVEC_CS_FILE -o czeng_token_head_docvec_cs -p $WORKERS
+  execute $CREATE_DOCVEC -d czeng_token_head_doc_en -w $CZENG_TOKEN_WORDVEC_EN_FILE -o czeng_token_head_docvec_en -p $WORKERS
 
-  execute $ALIGN_DOCVEC -s czeng_token_head_docvec_cs -t czeng_token_head_docvec_en -o czeng_token_head_align -n 20
+  execute $ALIGN_DOCVEC -s czeng_token_head_docvec_cs -t czeng_token_head_docvec_en -o czeng_token_head_align -n 20 -es $EXACT_SIZE -p $WORKERS
   execute $BENCH_ALIGN -a czeng_token_head_align -t czeng_token_head_doc_en -o czeng_token_head_align_bench
 
   execute $SCORE_ALIGN -a czeng_token_head_align -s czeng_token_head_doc_cs -t czeng_token_head_doc_en -m 1.08 -d 0.28 -w $CZENG_TOKEN_WEIGHT_FILE -o czeng_token_head_score
@@ -107,10 +117,10 @@ if [ $CZENG_TOKEN_ON -eq 1 ]; then
 
   # NOTE: Processing tokenized CzEng tail.
   execute $PREPARE_CZENG -c $CZENG_TOKEN_TAIL_FILE -cs czeng_token_tail_doc_cs -en czeng_token_tail_doc_en -b 50000
-  execute $CREATE_DOCVEC -d czeng_token_tail_doc_cs -w $CZENG_TOKEN_WORDVEC_CS_FILE -o czeng_token_tail_docvec_cs
-  execute $CREATE_DOCVEC -d czeng_token_tail_doc_en -w $CZENG_TOKEN_WORDVEC_EN_FILE -o czeng_token_tail_docvec_en
+  execute $CREATE_DOCVEC -d czeng_token_tail_doc_cs -w $CZENG_TOKEN_WORDVEC_CS_FILE -o czeng_token_tail_docvec_cs -p $WORKERS
+  execute $CREATE_DOCVEC -d czeng_token_tail_doc_en -w $CZENG_TOKEN_WORDVEC_EN_FILE -o czeng_token_tail_docvec_en -p $WORKERS
 
-  execute $ALIGN_DOCVEC -s czeng_token_tail_docvec_cs -t czeng_token_tail_docvec_en -o czeng_token_tail_align -n 20
+  execute $ALIGN_DOCVEC -s czeng_token_tail_docvec_cs -t czeng_token_tail_docvec_en -o czeng_token_tail_align -n 20 -es $EXACT_SIZE -p $WORKERS
   execute $BENCH_ALIGN -a czeng_token_tail_align -t czeng_token_tail_doc_en -o czeng_token_tail_align_bench
 
   execute $SCORE_ALIGN -a czeng_token_tail_align -s czeng_token_tail_doc_cs -t czeng_token_tail_doc_en -m 1.08 -d 0.28 -w $CZENG_TOKEN_WEIGHT_FILE -o czeng_token_tail_score
@@ -124,10 +134,13 @@ fi
 if [ $CZENG_LEMMA_ON -eq 1 ]; then
   # NOTE: Processing lemmatized CzEng head.
   execute $PREPARE_CZENG -c $CZENG_LEMMA_HEAD_FILE -cs czeng_lemma_head_doc_cs -en czeng_lemma_head_doc_en -b 50000
-  execute $CREATE_DOCVEC -d czeng_lemma_head_doc_cs -w $CZENG_LEMMA_WORDVEC_CS_FILE -o czeng_lemma_head_docvec_cs
-  execute $CREATE_DOCVEC -d czeng_lemma_head_doc_en -w $CZENG_LEMMA_WORDVEC_EN_FILE -o czeng_lemma_head_docvec_en
+  execute $CONVERT_WORDVEC -w $CZENG_LEMMA_WORDVEC_CS_FILE
+  execute $CONVERT_WORDVEC -w $CZENG_LEMMA_WORDVEC_EN_FILE
+  execute $CONVERT_WEIGHT -w $CZENG_LEMMA_WEIGHT_FILE
+  execute $CREATE_DOCVEC -d czeng_lemma_head_doc_cs -w $CZENG_LEMMA_WORDVEC_CS_FILE -o czeng_lemma_head_docvec_cs -p $WORKERS
+  execute $CREATE_DOCVEC -d czeng_lemma_head_doc_en -w $CZENG_LEMMA_WORDVEC_EN_FILE -o czeng_lemma_head_docvec_en -p $WORKERS
 
-  execute $ALIGN_DOCVEC -s czeng_lemma_head_docvec_cs -t czeng_lemma_head_docvec_en -o czeng_lemma_head_align -n 20
+  execute $ALIGN_DOCVEC -s czeng_lemma_head_docvec_cs -t czeng_lemma_head_docvec_en -o czeng_lemma_head_align -n 20 -es $EXACT_SIZE -p $WORKERS
   execute $BENCH_ALIGN -a czeng_lemma_head_align -t czeng_lemma_head_doc_en -o czeng_lemma_head_align_bench
 
   execute $SCORE_ALIGN -a czeng_lemma_head_align -s czeng_lemma_head_doc_cs -t czeng_lemma_head_doc_en -m 1.08 -d 0.28 -w $CZENG_LEMMA_WEIGHT_FILE -o czeng_lemma_head_score
@@ -137,10 +150,10 @@ if [ $CZENG_LEMMA_ON -eq 1 ]; then
 
   # NOTE: Processing lemmatized CzEng head.
   execute $PREPARE_CZENG -c $CZENG_LEMMA_TAIL_FILE -cs czeng_lemma_tail_doc_cs -en czeng_lemma_tail_doc_en -b 50000
-  execute $CREATE_DOCVEC -d czeng_lemma_tail_doc_cs -w $CZENG_LEMMA_WORDVEC_CS_FILE -o czeng_lemma_tail_docvec_cs
-  execute $CREATE_DOCVEC -d czeng_lemma_tail_doc_en -w $CZENG_LEMMA_WORDVEC_EN_FILE -o czeng_lemma_tail_docvec_en
+  execute $CREATE_DOCVEC -d czeng_lemma_tail_doc_cs -w $CZENG_LEMMA_WORDVEC_CS_FILE -o czeng_lemma_tail_docvec_cs -p $WORKERS
+  execute $CREATE_DOCVEC -d czeng_lemma_tail_doc_en -w $CZENG_LEMMA_WORDVEC_EN_FILE -o czeng_lemma_tail_docvec_en -p $WORKERS
 
-  execute $ALIGN_DOCVEC -s czeng_lemma_tail_docvec_cs -t czeng_lemma_tail_docvec_en -o czeng_lemma_tail_align -n 20
+  execute $ALIGN_DOCVEC -s czeng_lemma_tail_docvec_cs -t czeng_lemma_tail_docvec_en -o czeng_lemma_tail_align -n 20 -es $EXACT_SIZE -p $WORKERS
   execute $BENCH_ALIGN -a czeng_lemma_tail_align -t czeng_lemma_tail_doc_en -o czeng_lemma_tail_align_bench
 
   execute $SCORE_ALIGN -a czeng_lemma_tail_align -s czeng_lemma_tail_doc_cs -t czeng_lemma_tail_doc_en -m 1.08 -d 0.28 -w $CZENG_LEMMA_WEIGHT_FILE -o czeng_lemma_tail_score
@@ -154,10 +167,10 @@ fi
 if [ $CC_TOKEN_ON -eq 1 ]; then
   # NOTE: Processing tokenized CommonCrawl.
   execute $PREPARE_CC -c $CC_TOKEN_FILE -cs cc_token_doc_cs -en cc_token_doc_en
-  execute $CREATE_DOCVEC -d cc_token_doc_cs -w $CZENG_TOKEN_WORDVEC_CS_FILE -o cc_token_docvec_cs
-  execute $CREATE_DOCVEC -d cc_token_doc_en -w $CZENG_TOKEN_WORDVEC_EN_FILE -o cc_token_docvec_en
+  execute $CREATE_DOCVEC -d cc_token_doc_cs -w $CZENG_TOKEN_WORDVEC_CS_FILE -o cc_token_docvec_cs -p $WORKERS
+  execute $CREATE_DOCVEC -d cc_token_doc_en -w $CZENG_TOKEN_WORDVEC_EN_FILE -o cc_token_docvec_en -p $WORKERS
 
-  execute $ALIGN_DOCVEC -s cc_token_docvec_cs -t cc_token_docvec_en -o cc_token_align
+  execute $ALIGN_DOCVEC -s cc_token_docvec_cs -t cc_token_docvec_en -o cc_token_align -es $EXACT_SIZE -p $WORKERS
   execute $SCORE_ALIGN -a cc_token_align -s cc_token_doc_cs -t cc_token_doc_en -m 1.08 -d 0.28 -w $CZENG_TOKEN_WEIGHT_FILE -o cc_token_score
   execute $APPLY_CLASSIFIER -a cc_token_score -s cc_token_doc_cs -t cc_token_doc_en -m 1.08 -d 0.28 -w $CZENG_TOKEN_WEIGHT_FILE -c czeng_token_head_classifier -f 0.99  -o cc_token_class
   execute $DUMP_ALIGN -a cc_token_class -s cc_token_doc_cs -t cc_token_doc_en -o cc_token_class_dump
@@ -166,10 +179,10 @@ fi
 if [ $CC_LEMMA_ON -eq 1 ]; then
   # NOTE: Processing lemmatized CommonCrawl.
   execute $PREPARE_CC -c $CC_LEMMA_FILE -cs cc_lemma_doc_cs -en cc_lemma_doc_en
-  execute $CREATE_DOCVEC -d cc_lemma_doc_cs -w $CZENG_LEMMA_WORDVEC_CS_FILE -o cc_lemma_docvec_cs
-  execute $CREATE_DOCVEC -d cc_lemma_doc_en -w $CZENG_LEMMA_WORDVEC_EN_FILE -o cc_lemma_docvec_en
+  execute $CREATE_DOCVEC -d cc_lemma_doc_cs -w $CZENG_LEMMA_WORDVEC_CS_FILE -o cc_lemma_docvec_cs -p $WORKERS
+  execute $CREATE_DOCVEC -d cc_lemma_doc_en -w $CZENG_LEMMA_WORDVEC_EN_FILE -o cc_lemma_docvec_en -p $WORKERS
 
-  execute $ALIGN_DOCVEC -s cc_lemma_docvec_cs -t cc_lemma_docvec_en -o cc_lemma_align
+  execute $ALIGN_DOCVEC -s cc_lemma_docvec_cs -t cc_lemma_docvec_en -o cc_lemma_align -es $EXACT_SIZE -p $WORKERS
   execute $SCORE_ALIGN -a cc_lemma_align -s cc_lemma_doc_cs -t cc_lemma_doc_en -m 1.08 -d 0.28 -w $CZENG_LEMMA_WEIGHT_FILE -o cc_lemma_score
   execute $APPLY_CLASSIFIER -a cc_lemma_score -s cc_lemma_doc_cs -t cc_lemma_doc_en -m 1.08 -d 0.28 -w $CZENG_LEMMA_WEIGHT_FILE -c czeng_lemma_head_classifier -f 0.99  -o cc_lemma_class
   execute $DUMP_ALIGN -a cc_lemma_class -s cc_lemma_doc_cs -t cc_lemma_doc_en -o cc_lemma_class_dump
@@ -8,6 +8,8 @@ import logging
 import time
 import operator
 
+import bin_join
+
 
 logger_freq = 2
 logger_timestamp = time.time()
@@ -28,69 +30,20 @@ def log_minor(message, major=True):
 	logger.info(message)
 	logger_timestamp = time.time()
 
-def doc_file_bin_iter(doc_file):
-	bin_, docs = None, None
-
-	for line in doc_file:
-		
-		tokens = line.strip().split("\t")
-
-		doc_bin = tokens[0]
-		doc_id = tokens[1]
-		doc_text = tokens[2]
-
-		if doc_bin != bin_:
-			if bin_: yield (bin_, docs)
-			bin_, docs = doc_bin, {}
-
-		docs[doc_id] = doc_text
-
-	if bin_: yield (bin_, docs)
-
-def align_file_bin_iter(align_file):
-	bin_, aligns = None, None
-
-	for line in align_file:
-		
-		tokens = line.strip().split("\t")
-
-		align_bin = tokens[0]
-		src_doc_id = tokens[1]
-		trg_doc_id = tokens[2]
-		score = float(tokens[3])
-
-		if align_bin != bin_:
-			if bin_: yield (bin_, aligns)
-			bin_, aligns = align_bin, {}
-		
-		src_aligns = aligns.get(src_doc_id, [])
-		src_aligns.append((trg_doc_id, score))
-		aligns[src_doc_id] = src_aligns
-
-	if bin_: yield (bin_, aligns)
-
 def bench_align(align_file, trg_doc_file, output_file):
 	log_major("Benchmarking bins ...")
 
-	align_bin_iter = align_file_bin_iter(align_file)
-	trg_bin_iter = doc_file_bin_iter(trg_doc_file)
-	align_item, trg_item = None, None
+	align_bin_iter = bin_join.file_bin_iter(align_file)
+	trg_bin_iter = bin_join.file_bin_iter(trg_doc_file)
 
 	mindex_freqs = {}
 
 	align_index = 0
-	while True:
+	bin_iter = bin_join.join_bins(align_bin_iter, trg_bin_iter)
+	for align_bin, (align_lines, trg_lines) in bin_iter:
 
-		if not align_item: align_item = next(align_bin_iter, None)
-		if not trg_item: trg_item = next(trg_bin_iter, None)
-		if not align_item or not trg_item: break
-
-		align_bin, aligns = align_item
-		trg_bin, trg_docs = trg_item
-
-		if align_bin < trg_bin: align_bin = None
-		if trg_bin < align_bin: trg_bin = None
-		if align_bin != trg_bin: continue
+		aligns = bin_join.read_aligns(align_lines)
+		trg_docs = bin_join.read_docs(trg_lines)
 
 		log_major("Benchmarking bin '%s' ..." % align_bin)
 
@@ -118,8 +71,6 @@ def bench_align(align_file, trg_doc_file, output_file):
 
 		log_major("Bin '%s' benchmarked." % align_bin)
 
-		align_item, trg_item = None, None
-
 	log_major("All bins benchmarked.")
 	log_major("Outputting results ...")
 
@@ -0,0 +1,52 @@
+import json
+import struct
+import functools
+
+
+# Binary container of bins shared by the docvec files and the doc caches
+# (all numbers are little-endian):
+#
+#   magic                 8 bytes, identifies the format
+#   for every bin:
+#     payload             written and read by the format itself
+#   table                 utf-8 encoded JSON, with an entry for every bin
+#   table offset          uint64
+#   magic                 8 bytes, the same as at the start
+#
+# The table is written last, so a file missing the closing magic was not
+# written completely. Every bin entry is a list starting with the bin.
+
+footer = struct.Struct("<Q")
+
+def has_magic(bin_path, magic):
+	bin_file = open(bin_path, "rb")
+	file_magic = bin_file.read(len(magic))
+	bin_file.close()
+
+	return file_magic == magic
+
+def write_header(bin_file, magic):
+	bin_file.write(magic)
+
+def write_table(bin_file, magic, table):
+	table_offset = bin_file.tell()
+	bin_file.write(json.dumps(table).encode("utf-8"))
+	bin_file.write(footer.pack(table_offset))
+	bin_file.write(magic)
+
+def read_table(bin_file, magic):
+	bin_file.seek(-(footer.size + len(magic)), 2)
+	footer_end = bin_file.tell()
+
+	table_offset, = footer.unpack(bin_file.read(footer.size))
+	if bin_file.read(len(magic)) != magic:
+		raise ValueError("Bin file is incomplete or corrupted.")
+
+	bin_file.seek(table_offset)
+	table_bytes = bin_file.read(footer_end - table_offset)
+	return json.loads(table_bytes.decode("utf-8"))
+
+def bin_iter(bin_file, bin_table, read_bin):
+	# Yields (bin, loader) pairs, a bin is read only when its loader is called.
+	for bin_entry in bin_table:
+		yield (bin_entry[0], functools.partial(read_bin, bin_file, bin_entry))
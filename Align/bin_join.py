@@ -0,0 +1,66 @@
+import itertools
+
+
+# All the files passed between the stages are sorted by their first
+# column, the bin. Bins are streamed one at a time as groups of lines,
+# and a bin is parsed only if it is actually used. Skipping a bin just
+# reads past its lines, so the memory stays bounded by the largest bin.
+
+def bin_key(line):
+	return line.strip().split("\t", 1)[0]
+
+def file_bin_iter(bin_file):
+	for bin_, lines in itertools.groupby(bin_file, bin_key):
+		yield (bin_, lines)
+
+def join_bins(*bin_iters):
+	# Merge-join of iterators yielding (bin, payload) pairs sorted by the bin.
+	# Only the bins present in all the iterators are yielded. A payload is
+	# valid until the next bin is requested, since its iterator is lazy.
+	if not bin_iters: return
+
+	items = [next(bin_iter, None) for bin_iter in bin_iters]
+
+	while all(item is not None for item in items):
+
+		max_bin = max(item[0] for item in items)
+
+		if all(item[0] == max_bin for item in items):
+			yield (max_bin, [item[1] for item in items])
+			items = [next(bin_iter, None) for bin_iter in bin_iters]
+			continue
+
+		items = [next(bin_iter, None) if item[0] < max_bin else item
+			for item, bin_iter in zip(items, bin_iters)]
+
+def read_doc_list(lines):
+	docs = []
+	for line in lines:
+
+		tokens = line.strip().split("\t")
+
+		doc_id = tokens[1]
+		doc_text = tokens[2]
+
+		docs.append((doc_id, doc_text))
+
+	return docs
+
+def read_docs(lines):
+	return dict(read_doc_list(lines))
+
+def read_aligns(lines):
+	aligns = {}
+	for line in lines:
+
+		tokens = line.strip().split("\t")
+
+		src_doc_id = tokens[1]
+		trg_doc_id = tokens[2]
+		score = float(tokens[3])
+
+		src_aligns = aligns.get(src_doc_id, [])
+		src_aligns.append((trg_doc_id, score))
+		aligns[src_doc_id] = src_aligns
+
+	return aligns
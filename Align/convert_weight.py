@@ -0,0 +1,71 @@
+#!/usr/bin/env python
+
+import os
+import sys
+import argparse
+import codecs
+import logging
+import time
+
+import weight_table
+
+
+logger_freq = 2
+logger_timestamp = time.time()
+logger = logging.getLogger(__file__)
+
+def log_major(message):
+	global logger_timestamp
+
+	logger.info(message)
+	logger_timestamp = time.time()
+
+def log_minor(message, major=True):
+	global logger_timestamp
+
+	since_last = time.time() - logger_timestamp
+	if since_last < logger_freq: return
+
+	logger.info(message)
+	logger_timestamp = time.time()
+
+def convert_weight(weight_file, output):
+	# The store is read by weight_table.py, see there for the layout.
+
+	log_major("Reading weights ...")
+
+	words, weights = weight_table.read_weight_file(weight_file)
+
+	log_major("Weights read: %s weights of %s words." % (weights.nnz, len(words)))
+	log_major("Writing store ...")
+
+	weight_table.write_store(output, words, weights)
+
+	log_major("Store written.")
+
+
+if __name__ == "__main__":
+	logging_format = '>>> [%(filename)s][%(asctime)s] %(message)s'
+	logging.basicConfig(stream=sys.stdout, format=logging_format, level=logging.INFO)
+
+	parser = argparse.ArgumentParser(prog=__file__, add_help=False)
+	parser.add_argument('-w', '--weight', required=True, type=str)
+	parser.add_argument('-o', '--output', type=str, default=None)
+	args = parser.parse_args()
+
+	# The store is placed next to the weight file by default, so that
+	# the scripts using the weights pick it up without further options.
+	if not args.output: args.output = args.weight
+
+	log_major("Starting execution in %s." % os.getcwd())
+	for arg in vars(args): log_major("Option --%s = %s." % (arg, getattr(args, arg)))
+
+	weight_file = codecs.open(args.weight, "r", "utf-8")
+
+	try:
+		convert_weight(weight_file, args.output)
+		log_major("Script ended successfully.")
+	except:
+		log_major("Script ended unsucessfully!")
+	finally:
+		weight_file.close()
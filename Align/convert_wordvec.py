@@ -0,0 +1,107 @@
+#!/usr/bin/env python
+
+import os
+import sys
+import argparse
+import codecs
+import logging
+import time
+
+import numpy
+
+
+logger_freq = 2
+logger_timestamp = time.time()
+logger = logging.getLogger(__file__)
+
+def log_major(message):
+	global logger_timestamp
+
+	logger.info(message)
+	logger_timestamp = time.time()
+
+def log_minor(message, major=True):
+	global logger_timestamp
+
+	since_last = time.time() - logger_timestamp
+	if since_last < logger_freq: return
+
+	logger.info(message)
+	logger_timestamp = time.time()
+
+def wordvec_file_iter(wordvec_file):
+	# Skipping header line.
+	line = wordvec_file.readline()
+
+	for line in wordvec_file:
+
+		tokens = line.strip().split()
+
+		word = tokens[0]
+		wordvec = tokens[1:]
+
+		yield((word, wordvec))
+
+def convert_wordvec(wordvec_file, output):
+	# The store consists of a float32 matrix saved in the .npy format, which
+	# can be memory-mapped, and of a vocabulary listing words in row order.
+	# http://docs.scipy.org/doc/numpy/neps/npy-format.html
+
+	log_major("Reading header ...")
+
+	header = wordvec_file.readline().split()
+	wordvec_count, wordvec_length = int(header[0]), int(header[1])
+	wordvec_file.seek(0)
+
+	log_major("Header read: %s wordvecs of length %s." % (wordvec_count, wordvec_length))
+	log_major("Converting wordvecs ...")
+
+	matrix_path, vocab_path = output + ".npy", output + ".vocab"
+	matrix = numpy.lib.format.open_memmap(matrix_path, mode="w+",
+		dtype=numpy.float32, shape=(wordvec_count, wordvec_length))
+	vocab_file = codecs.open(vocab_path, "w", "utf-8")
+
+	wordvec_index = 0
+	for word, wordvec in wordvec_file_iter(wordvec_file):
+
+		log_minor("Converting wordvec %s." % (wordvec_index + 1))
+
+		matrix[wordvec_index] = wordvec
+		vocab_file.write("%s\n" % word)
+		wordvec_index += 1
+
+	if wordvec_index != wordvec_count:
+		raise ValueError("Expected %s wordvecs, found %s." % (wordvec_count, wordvec_index))
+
+	matrix.flush()
+	vocab_file.close()
+	del matrix
+
+	log_major("Wordvecs converted.")
+
+
+if __name__ == "__main__":
+	logging_format = '>>> [%(filename)s][%(asctime)s] %(message)s'
+	logging.basicConfig(stream=sys.stdout, format=logging_format, level=logging.INFO)
+
+	parser = argparse.ArgumentParser(prog=__file__, add_help=False)
+	parser.add_argument('-w', '--wordvec', required=True, type=str)
+	parser.add_argument('-o', '--output', type=str, default=None)
+	args = parser.parse_args()
+
+	# The store is placed next to the wordvec file by default,
+	# so that create_docvec.py picks it up without further options.
+	if not args.output: args.output = args.wordvec
+
+	log_major("Starting execution in %s." % os.getcwd())
+	for arg in vars(args): log_major("Option --%s = %s." % (arg, getattr(args, arg)))
+
+	wordvec_file = codecs.open(args.wordvec, "r", "utf-8")
+
+	try:
+		convert_wordvec(wordvec_file, args.output)
+		log_major("Script ended successfully.")
+	except:
+		log_major("Script ended unsucessfully!")
+	finally:
+		wordvec_file.close()
@@ -8,11 +8,21 @@ import logging
 import time
 import math
 
+import numpy
+import scipy.sparse as sparse
+
+import bin_join
+import docvec_format
+import ordered_pool
+
 
 logger_freq = 2
 logger_timestamp = time.time()
 logger = logging.getLogger(__file__)
 
+worker_wordvec_ids = None
+worker_wordvecs = None
+
 def log_major(message):
 	global logger_timestamp
 	
@@ -41,32 +51,28 @@ def wordvec_file_iter(wordvec_file):
 
 		yield((word, wordvec))
 
-def doc_file_bin_iter(doc_file):
-	bin_, docs = None, None
+def wordvec_store_exists(wordvec_path):
+	# The store is created by convert_wordvec.py next to the wordvec file.
+	# A store older than the wordvec file is considered stale and is ignored.
+	matrix_path, vocab_path = wordvec_path + ".npy", wordvec_path + ".vocab"
+	if not os.path.isfile(matrix_path) or not os.path.isfile(vocab_path): return False
 
-	for line in doc_file:
-		
-		tokens = line.strip().split("\t")
+	wordvec_mtime = os.path.getmtime(wordvec_path)
+	return min(os.path.getmtime(matrix_path), os.path.getmtime(vocab_path)) >= wordvec_mtime
 
-		doc_bin = tokens[0]
-		doc_id = tokens[1]
-		doc_text = tokens[2]
+def load_wordvec_store(wordvec_path):
+	# Memory-mapping allows the OS to share the pages among the processes.
+	wordvecs = numpy.load(wordvec_path + ".npy", mmap_mode="r")
 
-		if doc_bin != bin_:
-			if bin_: yield (bin_, docs)
-			bin_, docs = doc_bin, []
-			
-		docs.append((doc_id, doc_text))
-
-	if bin_: yield(bin_, docs)
-
-def create_docvec(doc_file, wordvec_file, output_file):
-	# WARNING: Wordvec normalization decreases precision!
-	# Normalization seems like a good idea but it is not.
+	vocab_file = codecs.open(wordvec_path + ".vocab", "r", "utf-8")
+	words = vocab_file.read().split("\n")[:len(wordvecs)]
+	vocab_file.close()
 
-	log_major("Loading wordvecs ...")
+	wordvec_ids = dict(zip(words, range(len(words))))
+	return (wordvec_ids, wordvecs)
 
-	wordvecs = {}
+def load_wordvec_file(wordvec_file):
+	wordvec_ids, wordvec_list = {}, []
 
 	wordvec_index = 0
 	for word, wordvec in wordvec_file_iter(wordvec_file):
@@ -74,80 +80,112 @@ def create_docvec(doc_file, wordvec_file, output_file):
 		wordvec_index += 1
 		log_minor("Loading wordvec %s." % wordvec_index)
 
-		wordvecs[word] = wordvec
+		wordvec_ids[word] = len(wordvec_list)
+		wordvec_list.append(wordvec)
 
-	log_major("Wordvecs loaded.")
-	log_major("Processing bins ...")
-	
-	doc_index = 0
-	for bin_, docs in doc_file_bin_iter(doc_file):
-		
-		log_major("Processing bin '%s' ..." % bin_)
-		log_major("Removing duplicates ...")
+	wordvecs = numpy.array(wordvec_list)
+	return (wordvec_ids, wordvecs)
+
+def remove_duplicates(docs):
+	docs_unique = []
+	docs_hashes = set()
+	for doc_id, doc_text in docs:
 
-		docs_unique = []
-		docs_hashes = set()
-		for doc_id, doc_text in docs:
+		doc_hash = hash(doc_text)
+		if doc_hash in docs_hashes: continue
 
-			doc_hash = hash(doc_text)
-			if doc_hash in docs_hashes: continue
+		docs_unique.append((doc_id, doc_text))
+		docs_hashes.add(doc_hash)
 
-			docs_unique.append((doc_id, doc_text))
-			docs_hashes.add(doc_hash)
+	return docs_unique
 
-		docs = docs_unique
+def create_bin_docvec(docs, wordvec_ids, wordvecs):
+	# Docvecs of the whole bin are a product of the sparse document-term
+	# Tf-idf matrix and the dense matrix of the wordvecs of the bin terms.
+	# Words without a wordvec do not contribute to any docvec, so their
+	# Tf-idf weights are never needed and they are dropped right away.
 
-		log_major("Duplicates removed.")
-		log_major("Processing Tf-idf model ...")
+	doc_ids, token_ids, doc_indptr = [], [], [0]
+	for doc_id, doc_text in docs:
 
-		freqs = {}
-		for _, doc_text in docs:
+		for word in doc_text.split():
 
-			doc_words = doc_text.split()
-			for word in set(doc_words):
+			wordvec_id = wordvec_ids.get(word)
+			if wordvec_id is not None: token_ids.append(wordvec_id)
 
-				freqs[word] = freqs.get(word, 0) + 1
+		doc_ids.append(doc_id)
+		doc_indptr.append(len(token_ids))
 
-		idfs = {}
-		for word, freq in freqs.items():
-			idfs[word] = math.log(len(docs) / float(freq), 10)
+	token_ids = numpy.array(token_ids, dtype=numpy.int64)
+	term_ids, token_terms = numpy.unique(token_ids, return_inverse=True)
 
-		log_major("Tf-idf model processed.")
-		log_major("Processing documents ...")
+	# Duplicate entries of the CSR matrix are summed up into term frequencies.
+	tfs = sparse.csr_matrix((numpy.ones(len(token_terms)), token_terms, doc_indptr),
+		shape=(len(doc_ids), len(term_ids)))
+	tfs.sum_duplicates()
 
-		for doc_id, doc_text in docs:
+	# Same formula as math.log(x, 10) to keep the docvecs unchanged.
+	freqs = numpy.bincount(tfs.indices, minlength=len(term_ids))
+	idfs = numpy.log(len(docs) / freqs.astype(float)) / math.log(10)
 
-			doc_index += 1
-			log_minor("Processing document %s." % doc_index)
+	tfidfs = tfs
+	tfidfs.data *= idfs[tfidfs.indices]
 
-			doc_words = doc_text.split()
+	docvecs = tfidfs.dot(wordvecs[term_ids].astype(float))
+	docvecs_mask = numpy.diff(tfidfs.indptr) > 0
 
-			tfs = {}
-			for word in doc_words:
-				tfs[word] = tfs.get(word, 0) + 1
+	doc_ids = [doc_id for doc_id, mask in zip(doc_ids, docvecs_mask) if mask]
+	docvecs = docvecs[docvecs_mask]
+	return (doc_ids, docvecs)
 
-			tfidfs = {}
-			for word in set(doc_words):
-				tfidfs[word] = tfs[word] * idfs[word]
+def init_worker(wordvec_ids, wordvecs):
+	# Workers are forked, so the wordvecs are passed without pickling and
+	# the memory-mapped store shares its pages with the parent process.
+	global worker_wordvec_ids, worker_wordvecs
 
-			docvec = None
-			for word, tfidf in tfidfs.items():
+	worker_wordvec_ids = wordvec_ids
+	worker_wordvecs = wordvecs
 
-				wordvec = wordvecs.get(word)
-				if not wordvec: continue
+def process_bin(bin_item):
+	bin_, docs = bin_item
 
-				if not docvec: docvec = [0] * len(wordvec)
-				tfidfs_wordvec = [x * tfidf for x in wordvec]
-				docvec = [sum(x) for x in zip(docvec, tfidfs_wordvec)]
+	docs = remove_duplicates(docs)
+	doc_ids, docvecs = create_bin_docvec(docs, worker_wordvec_ids, worker_wordvecs)
+	return (bin_, doc_ids, docvecs)
 
-			if docvec:
-				docvec_str = " ".join(map(str, docvec))
-				output_row = "\t".join(map(str, (bin_, doc_id, docvec_str)))
-				output_file.write("%s\n" % output_row)
+def processed_bin_iter(doc_file, wordvec_ids, wordvecs, workers):
+	bin_items = ((bin_, bin_join.read_doc_list(doc_lines)) for bin_, doc_lines in bin_join.file_bin_iter(doc_file))
+	return ordered_pool.ordered_map(process_bin, bin_items, workers, init_worker, (wordvec_ids, wordvecs))
+
+def create_docvec(doc_file, wordvec_path, output_file, workers, text):
+	# WARNING: Wordvec normalization decreases precision!
+	# Normalization seems like a good idea but it is not.
+
+	if wordvec_store_exists(wordvec_path):
+		log_major("Loading wordvec store ...")
+		wordvec_ids, wordvecs = load_wordvec_store(wordvec_path)
+	else:
+		log_major("Loading wordvecs (run convert_wordvec.py to speed this up) ...")
+		wordvec_file = codecs.open(wordvec_path, "r", "utf-8")
+		wordvec_ids, wordvecs = load_wordvec_file(wordvec_file)
+		wordvec_file.close()
+
+	log_major("Wordvecs loaded.")
+	log_major("Processing bins ...")
+
+	if not text: bin_table = docvec_format.write_header(output_file)
+
+	for bin_, doc_ids, docvecs in processed_bin_iter(doc_file, wordvec_ids, wordvecs, workers):
+
+		log_major("Writing bin '%s' ..." % bin_)
+
+		if text: docvec_format.write_text_bin(output_file, bin_, doc_ids, docvecs)
+		else: docvec_format.write_bin(output_file, bin_table, bin_, doc_ids, docvecs)
 
-		log_major("Documents processed.")
 		log_major("Bin '%s' processed." % bin_)
 
+	if not text: docvec_format.write_table(output_file, bin_table)
+
 	log_major("All bins processed.")
 
 
@@ -159,21 +197,23 @@ if __name__ == "__main__":
 	parser.add_argument('-d', '--doc', required=True, type=str)
 	parser.add_argument('-w', '--wordvec', required=True, type=str)
 	parser.add_argument('-o', '--output', required=True, type=str)
+	parser.add_argument('-p', '--workers', type=int, default=1)
+	parser.add_argument('-x', '--text', action='store_true', default=False)
 	args = parser.parse_args()
 
 	log_major("Starting execution in %s." % os.getcwd())
 	for arg in vars(args): log_major("Option --%s = %s." % (arg, getattr(args, arg)))
 
 	doc_file = codecs.open(args.doc, "r", "utf-8")
-	wordvec_file = codecs.open(args.wordvec, "r", "utf-8")
-	output_file = codecs.open(args.output, "w", "utf-8")
+	# The text format is meant for debugging, the binary one is the default.
+	if args.text: output_file = codecs.open(args.output, "w", "utf-8")
+	else: output_file = open(args.output, "wb")
 
 	try:
-		create_docvec(doc_file, wordvec_file, output_file)
+		create_docvec(doc_file, args.wordvec, output_file, args.workers, args.text)
 		log_major("Script ended successfully.")
 	except:
 		log_major("Script ended unsucessfully!")
 	finally:
 		doc_file.close()
-		wordvec_file.close()
 		output_file.close()
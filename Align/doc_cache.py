@@ -0,0 +1,143 @@
+import os
+import struct
+import codecs
+import hashlib
+
+import numpy
+
+import bin_container
+import bin_join
+
+
+# Tokenized documents, cached next to the doc file as <doc>.cache, so that
+# the scoring and classification stages do not split the texts again on
+# every run. The cache is rebuilt whenever it is older than the doc file or
+# was built with a different vocabulary. The cache is a bin container with
+# the magic "DOCTOK01" (see bin_container) and the bin payload
+# (little-endian):
+#
+#   doc hashes            n int64, hashes of the document texts
+#   doc lengths           n int64, lengths of the texts in characters
+#   token pointers        n + 1 int64, token range of every document
+#   token ids             t int64, word ids of the document tokens
+#   word lengths          t int32, lengths of the tokens in characters
+#   doc ids               utf-8 encoded ids separated by newlines
+#
+# The table is a JSON object with the vocabulary key and the bins, a list
+# of [bin, n, t, offset, ids_length] for every bin.
+#
+# Known words have their vocabulary id, unknown words a negative id derived
+# from the word itself, so equal words have equal ids either way.
+
+magic = b"DOCTOK01"
+hash_struct = struct.Struct("<q")
+
+int64_dtype = numpy.dtype("<i8")
+int32_dtype = numpy.dtype("<i4")
+
+def text_hash(text):
+	return hash_struct.unpack(hashlib.md5(text.encode("utf-8")).digest()[:hash_struct.size])[0]
+
+def vocab_key(word_ids):
+	words = sorted(word_ids, key=word_ids.get)
+	return hashlib.md5("\n".join(words).encode("utf-8")).hexdigest()
+
+def token_id(word, word_ids):
+	word_id = word_ids.get(word)
+	if word_id is not None: return word_id
+
+	return -(text_hash(word) & 0x7fffffffffffffff) - 1
+
+def write_bin(cache_file, bin_table, bin_, docs, word_ids):
+	doc_ids, doc_hashes, doc_lengths = [], [], []
+	token_indptr, token_ids, word_lengths = [0], [], []
+
+	for doc_id, doc_text in docs:
+
+		words = doc_text.split()
+		token_ids.extend(token_id(word, word_ids) for word in words)
+		word_lengths.extend(len(word) for word in words)
+
+		doc_ids.append(doc_id)
+		doc_hashes.append(text_hash(doc_text))
+		doc_lengths.append(len(doc_text))
+		token_indptr.append(len(token_ids))
+
+	bin_offset = cache_file.tell()
+	cache_file.write(numpy.array(doc_hashes, dtype=int64_dtype).tobytes())
+	cache_file.write(numpy.array(doc_lengths, dtype=int64_dtype).tobytes())
+	cache_file.write(numpy.array(token_indptr, dtype=int64_dtype).tobytes())
+	cache_file.write(numpy.array(token_ids, dtype=int64_dtype).tobytes())
+	cache_file.write(numpy.array(word_lengths, dtype=int32_dtype).tobytes())
+
+	ids_bytes = "\n".join(doc_ids).encode("utf-8")
+	cache_file.write(ids_bytes)
+
+	bin_table.append([bin_, len(doc_ids), len(token_ids), bin_offset, len(ids_bytes)])
+
+def write_cache(doc_path, cache_path, word_ids, cache_key):
+	# Written to a temporary file first, so that a reader never sees an
+	# incomplete cache, even if several stages build it at the same time.
+	temp_path = "%s.%s.tmp" % (cache_path, os.getpid())
+	doc_file = codecs.open(doc_path, "r", "utf-8")
+	cache_file = open(temp_path, "wb")
+
+	try:
+		bin_container.write_header(cache_file, magic)
+
+		bin_table = []
+		for bin_, lines in bin_join.file_bin_iter(doc_file):
+			write_bin(cache_file, bin_table, bin_, bin_join.read_doc_list(lines), word_ids)
+
+		bin_container.write_table(cache_file, magic, {"vocab": cache_key, "bins": bin_table})
+	finally:
+		cache_file.close()
+		doc_file.close()
+
+	os.rename(temp_path, cache_path)
+
+def cache_valid(doc_path, cache_path, cache_key):
+	if not os.path.isfile(cache_path): return False
+	if os.path.getmtime(cache_path) < os.path.getmtime(doc_path): return False
+
+	cache_file = open(cache_path, "rb")
+	try:
+		return bin_container.read_table(cache_file, magic)["vocab"] == cache_key
+	except ValueError:
+		return False
+	finally:
+		cache_file.close()
+
+def read_bin(cache_file, bin_entry):
+	# Returns a dict of (doc_hash, doc_length, token_ids, word_lengths) tuples
+	# by the doc ids, the arrays are views into the arrays of the whole bin.
+	_, doc_count, token_count, bin_offset, ids_length = bin_entry
+
+	cache_file.seek(bin_offset)
+	doc_hashes = numpy.fromfile(cache_file, dtype=int64_dtype, count=doc_count)
+	doc_lengths = numpy.fromfile(cache_file, dtype=int64_dtype, count=doc_count)
+	token_indptr = numpy.fromfile(cache_file, dtype=int64_dtype, count=doc_count + 1)
+	token_ids = numpy.fromfile(cache_file, dtype=int64_dtype, count=token_count)
+	word_lengths = numpy.fromfile(cache_file, dtype=int32_dtype, count=token_count)
+	doc_ids = cache_file.read(ids_length).decode("utf-8").split("\n")
+
+	docs = {}
+	for index, (doc_hash, doc_length) in enumerate(zip(doc_hashes.tolist(), doc_lengths.tolist())):
+
+		token_start, token_end = token_indptr[index], token_indptr[index + 1]
+		docs[doc_ids[index]] = (doc_hash, doc_length,
+			token_ids[token_start:token_end], word_lengths[token_start:token_end])
+
+	return docs
+
+def bin_iter(cache_file):
+	return bin_container.bin_iter(cache_file, bin_container.read_table(cache_file, magic)["bins"], read_bin)
+
+def open_cache(doc_path, word_ids):
+	# Returns the cache file and its bin iterator, the cache is built first
+	# if there is no valid one.
+	cache_path, cache_key = doc_path + ".cache", vocab_key(word_ids)
+	if not cache_valid(doc_path, cache_path, cache_key): write_cache(doc_path, cache_path, word_ids, cache_key)
+
+	cache_file = open(cache_path, "rb")
+	return (cache_file, bin_iter(cache_file))
@@ -0,0 +1,85 @@
+import functools
+
+import numpy
+
+import bin_container
+import bin_join
+
+
+# Binary docvec file, a bin container with the magic "DOCVEC01" (see
+# bin_container) and the bin payload (little-endian):
+#
+#   docvecs               n x dim float32 matrix in row-major order
+#   doc ids               utf-8 encoded ids separated by newlines
+#
+# The table is a JSON list of [bin, n, dim, docvecs offset, ids offset,
+# ids length] for every bin.
+#
+# The bins are stored in the order they were written, which is the order
+# of the doc file they were created from.
+
+magic = b"DOCVEC01"
+docvec_dtype = numpy.dtype("<f4")
+
+def is_binary(docvec_path):
+	return bin_container.has_magic(docvec_path, magic)
+
+def write_header(docvec_file):
+	bin_container.write_header(docvec_file, magic)
+	return []
+
+def write_bin(docvec_file, bin_table, bin_, doc_ids, docvecs):
+	if not doc_ids: return
+
+	docvecs = numpy.ascontiguousarray(docvecs, dtype=docvec_dtype)
+	docvecs_offset = docvec_file.tell()
+	docvec_file.write(docvecs.tobytes())
+
+	ids_offset = docvec_file.tell()
+	ids_bytes = "\n".join(doc_ids).encode("utf-8")
+	docvec_file.write(ids_bytes)
+
+	bin_entry = [bin_, docvecs.shape[0], docvecs.shape[1], docvecs_offset, ids_offset, len(ids_bytes)]
+	bin_table.append(bin_entry)
+
+def write_table(docvec_file, bin_table):
+	bin_container.write_table(docvec_file, magic, bin_table)
+
+def read_bin(docvec_file, bin_entry):
+	_, docvec_count, docvec_length, docvecs_offset, ids_offset, ids_length = bin_entry
+
+	docvec_file.seek(docvecs_offset)
+	docvecs = numpy.fromfile(docvec_file, dtype=docvec_dtype, count=docvec_count * docvec_length)
+	docvecs = docvecs.reshape((docvec_count, docvec_length))
+
+	docvec_file.seek(ids_offset)
+	doc_ids = docvec_file.read(ids_length).decode("utf-8").split("\n")
+	return (doc_ids, docvecs)
+
+def bin_iter(docvec_file):
+	return bin_container.bin_iter(docvec_file, bin_container.read_table(docvec_file, magic), read_bin)
+
+def write_text_bin(docvec_file, bin_, doc_ids, docvecs):
+	for doc_id, docvec in zip(doc_ids, docvecs.tolist()):
+
+		docvec_str = " ".join(map(str, docvec))
+		output_row = "\t".join(map(str, (bin_, doc_id, docvec_str)))
+		docvec_file.write("%s\n" % output_row)
+
+def read_text_bin(lines):
+	doc_ids, docvecs = [], []
+	for line in lines:
+
+		tokens = line.strip().split("\t")
+
+		doc_id = tokens[1]
+		docvec = map(float, tokens[2].split())
+
+		doc_ids.append(doc_id)
+		docvecs.append(docvec)
+
+	return (doc_ids, numpy.array(docvecs))
+
+def text_bin_iter(docvec_file):
+	for bin_, lines in bin_join.file_bin_iter(docvec_file):
+		yield (bin_, functools.partial(read_text_bin, lines))
@@ -9,6 +9,8 @@ import time
 import math
 import operator
 
+import bin_join
+
 
 logger_freq = 2
 logger_timestamp = time.time()
@@ -29,71 +31,20 @@ def log_minor(message, major=True):
 	logger.info(message)
 	logger_timestamp = time.time()
 
-def doc_file_bin_iter(doc_file):
-	bin_, docs = None, None
-
-	for line in doc_file:
-		
-		tokens = line.strip().split("\t")
-
-		doc_bin = tokens[0]
-		doc_id = tokens[1]
-		doc_text = tokens[2]
-
-		if doc_bin != bin_:
-			if bin_: yield (bin_, docs)
-			bin_, docs = doc_bin, {}
-
-		docs[doc_id] = doc_text
-
-	if bin_: yield (bin_, docs)
-
-def align_file_bin_iter(align_file):
-	bin_, aligns = None, None
-
-	for line in align_file:
-		
-		tokens = line.strip().split("\t")
-
-		align_bin = tokens[0]
-		src_doc_id = tokens[1]
-		trg_doc_id = tokens[2]
-		score = float(tokens[3])
-
-		if align_bin != bin_:
-			if bin_: yield (bin_, aligns)
-			bin_, aligns = align_bin, {}
-		
-		src_aligns = aligns.get(src_doc_id, [])
-		src_aligns.append((trg_doc_id, score))
-		aligns[src_doc_id] = src_aligns
-
-	if bin_: yield (bin_, aligns)
-
-def score_align(align_file, src_doc_file, trg_doc_file, output_file, debug):
+def dump_align(align_file, src_doc_file, trg_doc_file, output_file, debug):
 	log_major("Dumping bins ...")
 
-	align_bin_iter = align_file_bin_iter(align_file)
-	src_bin_iter = doc_file_bin_iter(src_doc_file)
-	trg_bin_iter = doc_file_bin_iter(trg_doc_file)
-	align_item, src_item, trg_item = None, None, None
+	align_bin_iter = bin_join.file_bin_iter(align_file)
+	src_bin_iter = bin_join.file_bin_iter(src_doc_file)
+	trg_bin_iter = bin_join.file_bin_iter(trg_doc_file)
 
 	align_index = 0
-	while True:
+	bin_iter = bin_join.join_bins(align_bin_iter, src_bin_iter, trg_bin_iter)
+	for align_bin, (align_lines, src_lines, trg_lines) in bin_iter:
 
-		if not align_item: align_item = next(align_bin_iter, None)
-		if not src_item: src_item = next(src_bin_iter, None)
-		if not trg_item: trg_item = next(trg_bin_iter, None)
-		if not align_item or not src_item or not trg_item: break
-
-		align_bin, aligns = align_item
-		src_bin, src_docs = src_item
-		trg_bin, trg_docs = trg_item
-
-		if align_bin < max(src_bin, trg_bin): align_item = None
-		if src_bin < max(align_bin, trg_bin): src_item = None
-		if trg_bin < max(align_bin, src_bin): trg_item = None
-		if not align_bin == src_bin == trg_bin: continue
+		aligns = bin_join.read_aligns(align_lines)
+		src_docs = bin_join.read_docs(src_lines)
+		trg_docs = bin_join.read_docs(trg_lines)
 
 		log_major("Dumping bin '%s' ..." % align_bin)
 
@@ -109,7 +60,7 @@ def score_align(align_file, src_doc_file, trg_doc_file, output_file, debug):
 
 				trg_doc_text = trg_docs[trg_doc_id]
 
-				output_row = "\t".join(map(str, (src_bin, src_doc_id, trg_doc_id, score)))
+				output_row = "\t".join(map(str, (align_bin, src_doc_id, trg_doc_id, score)))
 				output_file.write("%s\n" % output_row)
 				output_file.write("%s\n" % src_doc_text)
 				output_file.write("%s\n" % trg_doc_text)
@@ -121,9 +72,7 @@ def score_align(align_file, src_doc_file, trg_doc_file, output_file, debug):
 				# Separating with an empty line.
 				output_file.write("\n")
 
-		log_major("Bin '%s' scored." % align_bin)
-
-		align_item, src_item, trg_item = None, None, None
+		log_major("Bin '%s' dumped." % align_bin)
 
 	log_major("All bins dumped.")
 
@@ -149,7 +98,7 @@ if __name__ == "__main__":
 	output_file = codecs.open(args.output, "w", "utf-8")
 
 	try:
-		score_align(align_file, src_doc_file, trg_doc_file, output_file, args.debug)
+		dump_align(align_file, src_doc_file, trg_doc_file, output_file, args.debug)
 		log_major("Script ended successfully.")
 	except:
 		log_major("Script ended unsucessfully!")
@@ -0,0 +1,98 @@
+import os
+import json
+import glob
+import codecs
+
+import numpy
+
+
+# Training data of the classifiers, stored in a directory as append-only
+# chunks of .npy files, one chunk for every bin:
+#
+#   chunk_<index>.features.npy   float64 matrix of the feature rows
+#   chunk_<index>.labels.npy     int8 labels, 1 for the correct alignments
+#   chunk_<index>.bins.npy       unicode bins of the alignments
+#   chunk_<index>.src_ids.npy    unicode source doc ids
+#   chunk_<index>.trg_ids.npy    unicode target doc ids
+#   meta.json                    options the features were extracted with
+#
+# The meta file is written last, so a store without it is incomplete. A
+# store is reused only if it was extracted with the same options and is
+# newer than all the input files, otherwise it is extracted again.
+
+chunk_suffixes = [".features.npy", ".labels.npy", ".bins.npy", ".src_ids.npy", ".trg_ids.npy"]
+
+def meta_path(store_path):
+	return os.path.join(store_path, "meta.json")
+
+def chunk_prefix(store_path, chunk_index):
+	return os.path.join(store_path, "chunk_%06d" % chunk_index)
+
+def store_valid(store_path, meta, input_paths):
+	if not os.path.isfile(meta_path(store_path)): return False
+
+	meta_file = codecs.open(meta_path(store_path), "r", "utf-8")
+	store_meta = json.load(meta_file)
+	meta_file.close()
+
+	if store_meta.get("options") != meta: return False
+
+	store_mtime = os.path.getmtime(meta_path(store_path))
+	return all(os.path.getmtime(input_path) <= store_mtime for input_path in input_paths)
+
+def create_store(store_path, meta):
+	# Returns the state of the store being written, any previous content
+	# of the store is removed.
+	if not os.path.isdir(store_path): os.makedirs(store_path)
+
+	if os.path.isfile(meta_path(store_path)): os.remove(meta_path(store_path))
+	for chunk_path in glob.glob(os.path.join(store_path, "chunk_*")): os.remove(chunk_path)
+
+	return {"path": store_path, "meta": meta, "chunks": 0, "rows": 0}
+
+def append_chunk(store, aligns, inps, outs):
+	# Aligns are (bin, src_doc_id, trg_doc_id) triples of the feature rows.
+	if not inps: return
+
+	prefix = chunk_prefix(store["path"], store["chunks"])
+	bins, src_doc_ids, trg_doc_ids = zip(*aligns)
+
+	numpy.save(prefix + ".features.npy", numpy.array(inps, dtype=numpy.float64))
+	numpy.save(prefix + ".labels.npy", numpy.array(outs, dtype=numpy.int8))
+	numpy.save(prefix + ".bins.npy", numpy.array(bins, dtype=numpy.unicode_))
+	numpy.save(prefix + ".src_ids.npy", numpy.array(src_doc_ids, dtype=numpy.unicode_))
+	numpy.save(prefix + ".trg_ids.npy", numpy.array(trg_doc_ids, dtype=numpy.unicode_))
+
+	store["chunks"] += 1
+	store["rows"] += len(inps)
+
+def close_store(store):
+	meta_file = codecs.open(meta_path(store["path"]), "w", "utf-8")
+	json.dump({"options": store["meta"], "chunks": store["chunks"], "rows": store["rows"]}, meta_file)
+	meta_file.close()
+
+def chunk_iter(store_path):
+	# Yields the chunks as dicts of memory-mapped arrays by their names.
+	meta_file = codecs.open(meta_path(store_path), "r", "utf-8")
+	chunk_count = json.load(meta_file)["chunks"]
+	meta_file.close()
+
+	for chunk_index in range(chunk_count):
+
+		prefix = chunk_prefix(store_path, chunk_index)
+		chunk = {}
+		for suffix in chunk_suffixes:
+			name = suffix[1:-len(".npy")]
+			chunk[name] = numpy.load(prefix + suffix, mmap_mode="r")
+
+		yield chunk
+
+def load_data(store_path):
+	# Returns the feature matrix and the labels of the whole store.
+	features, labels = [], []
+	for chunk in chunk_iter(store_path):
+		features.append(chunk["features"])
+		labels.append(chunk["labels"])
+
+	if not features: return (numpy.zeros((0, 0)), numpy.zeros(0, dtype=numpy.int8))
+	return (numpy.concatenate(features), numpy.concatenate(labels))
@@ -8,6 +8,8 @@ import logging
 import time
 import operator
 
+import bin_join
+
 
 logger_freq = 2
 logger_timestamp = time.time()
@@ -28,33 +30,13 @@ def log_minor(message, major=True):
 	logger.info(message)
 	logger_timestamp = time.time()
 
-def align_file_bin_iter(align_file):
-	bin_, aligns = None, None
-
-	for line in align_file:
-		
-		tokens = line.strip().split("\t")
-
-		align_bin = tokens[0]
-		src_doc_id = tokens[1]
-		trg_doc_id = tokens[2]
-		score = float(tokens[3])
-
-		if align_bin != bin_:
-			if bin_: yield (bin_, aligns)
-			bin_, aligns = align_bin, {}
-		
-		src_aligns = aligns.get(src_doc_id, [])
-		src_aligns.append((trg_doc_id, score))
-		aligns[src_doc_id] = src_aligns
-
-	if bin_: yield (bin_, aligns)
-
 def filter_align(align_file, threshold, output_file):
 	log_major("Filtering bins ...")
 
 	align_index = 0
-	for align_bin, aligns in align_file_bin_iter(align_file):
+	for align_bin, align_lines in bin_join.file_bin_iter(align_file):
+
+		aligns = bin_join.read_aligns(align_lines)
 
 		log_major("Filtering bin '%s' ..." % align_bin)
 
@@ -73,8 +55,6 @@ def filter_align(align_file, threshold, output_file):
 
 		log_major("Bin '%s' filtered." % align_bin)
 
-		align_item, trg_item = None, None
-
 	log_major("All bins filtered.")
 
 
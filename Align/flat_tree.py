@@ -0,0 +1,81 @@
+import pickle
+import zipfile
+
+import numpy
+
+
+# Decision tree flattened into plain arrays indexed by the node, so that it
+# can be evaluated without scikit-learn:
+#
+#   features      feature compared in the node, -1 in the leaves
+#   thresholds    the node goes left if the feature is at most the threshold
+#   lefts         left child, -1 in the leaves
+#   rights        right child, -1 in the leaves
+#   probabs       probability of the positive class in the node
+#
+# The tree is saved in the .npz format. The root is the node 0.
+
+def export_tree(clf):
+	# Flattens a fitted sklearn.tree.DecisionTreeClassifier.
+	tree_ = clf.tree_
+
+	# Leaf probabilities are normalized class counts, as in predict_proba.
+	# A tree trained without any positive sample has the probability 0.
+	class_counts = tree_.value[:, 0, :]
+	if 1 in list(clf.classes_):
+		positive_index = list(clf.classes_).index(1)
+		probabs = class_counts[:, positive_index] / class_counts.sum(axis=1)
+	else:
+		probabs = numpy.zeros(tree_.node_count)
+
+	return {
+		"features": tree_.feature.astype(numpy.int64),
+		"thresholds": tree_.threshold.astype(numpy.float64),
+		"lefts": tree_.children_left.astype(numpy.int64),
+		"rights": tree_.children_right.astype(numpy.int64),
+		"probabs": probabs.astype(numpy.float64),
+	}
+
+def save_tree(flat_tree, tree_path):
+	tree_file = open(tree_path, "wb")
+	numpy.savez(tree_file, **flat_tree)
+	tree_file.close()
+
+def load_tree(tree_path):
+	# Classifiers pickled by older versions of train_tree.py are flattened
+	# on load, which is the only case when scikit-learn gets imported.
+	if not zipfile.is_zipfile(tree_path):
+		tree_file = open(tree_path, "rb")
+		clf = pickle.load(tree_file)
+		tree_file.close()
+
+		return export_tree(clf)
+
+	tree_arrays = numpy.load(tree_path)
+	flat_tree = dict((name, tree_arrays[name]) for name in tree_arrays.files)
+	tree_arrays.close()
+
+	return flat_tree
+
+def predict_proba(flat_tree, inps):
+	# Probabilities of the positive class of all the rows of inps. All the
+	# rows descend one level at a time, so the loop runs at most the depth
+	# of the tree times. scikit-learn compares the features in float32.
+	inps = numpy.asarray(inps, dtype=numpy.float32)
+	features, thresholds = flat_tree["features"], flat_tree["thresholds"]
+	lefts, rights = flat_tree["lefts"], flat_tree["rights"]
+
+	nodes = numpy.zeros(len(inps), dtype=numpy.int64)
+
+	inner = numpy.flatnonzero(lefts[nodes] != -1)
+	while len(inner) > 0:
+
+		inner_nodes = nodes[inner]
+		values = inps[inner, features[inner_nodes]]
+
+		goes_left = values <= thresholds[inner_nodes]
+		nodes[inner] = numpy.where(goes_left, lefts[inner_nodes], rights[inner_nodes])
+
+		inner = inner[lefts[nodes[inner]] != -1]
+
+	return flat_tree["probabs"][nodes]
@@ -0,0 +1,72 @@
+import numpy
+
+
+# Feed-forward network with one sigmoid hidden layer and a softmax output
+# layer, the same architecture as pybrain's buildNetwork(indim, hiddim,
+# outdim, outclass=SoftmaxLayer). The network is a dict of four arrays and
+# is saved in the .npz format, which is compact and loads instantly.
+# http://docs.scipy.org/doc/numpy/reference/generated/numpy.savez.html
+
+def create_network(indim, hiddim, outdim, rng):
+	# Small random weights break the symmetry of the hidden units.
+	return {
+		"hidden_weights": rng.normal(0., 1. / numpy.sqrt(indim), (indim, hiddim)),
+		"hidden_biases": numpy.zeros(hiddim),
+		"output_weights": rng.normal(0., 1. / numpy.sqrt(hiddim), (hiddim, outdim)),
+		"output_biases": numpy.zeros(outdim),
+	}
+
+def save_network(network, network_path):
+	network_file = open(network_path, "wb")
+	numpy.savez(network_file, **network)
+	network_file.close()
+
+def load_network(network_path):
+	network_arrays = numpy.load(network_path)
+	network = dict((name, network_arrays[name]) for name in network_arrays.files)
+	network_arrays.close()
+
+	return network
+
+def sigmoid(x):
+	return 1. / (1. + numpy.exp(-x))
+
+def softmax(x):
+	exp_x = numpy.exp(x - x.max(axis=1)[:, numpy.newaxis])
+	return exp_x / exp_x.sum(axis=1)[:, numpy.newaxis]
+
+def forward(network, inps):
+	hidden = sigmoid(inps.dot(network["hidden_weights"]) + network["hidden_biases"])
+	outs = softmax(hidden.dot(network["output_weights"]) + network["output_biases"])
+	return (hidden, outs)
+
+def activate(network, inps):
+	# Class probabilities of all the rows of inps at once.
+	return forward(network, numpy.asarray(inps, dtype=float))[1]
+
+def train_epoch(network, inps, classes, learning_rate, batch_size, rng):
+	# One pass of mini-batch gradient descent on the cross-entropy loss,
+	# over the samples in a random order.
+	order = rng.permutation(len(inps))
+	targets = numpy.eye(network["output_biases"].shape[0])[classes]
+
+	for batch_start in range(0, len(order), batch_size):
+
+		batch = order[batch_start:batch_start + batch_size]
+		batch_inps, batch_targets = inps[batch], targets[batch]
+
+		hidden, outs = forward(network, batch_inps)
+
+		output_deltas = (outs - batch_targets) / len(batch)
+		hidden_deltas = output_deltas.dot(network["output_weights"].T) * hidden * (1. - hidden)
+
+		network["output_weights"] -= learning_rate * hidden.T.dot(output_deltas)
+		network["output_biases"] -= learning_rate * output_deltas.sum(axis=0)
+		network["hidden_weights"] -= learning_rate * batch_inps.T.dot(hidden_deltas)
+		network["hidden_biases"] -= learning_rate * hidden_deltas.sum(axis=0)
+
+def percent_error(network, inps, classes):
+	if len(inps) == 0: return 0.
+
+	predicted = activate(network, inps).argmax(axis=1)
+	return 100. * numpy.mean(predicted != classes)
@@ -32,7 +32,7 @@ function handle_options() {
     shift
   done
 
-  if [ -z "$CZENG_FILE" ] || [ ! -f "$CZENG_FILE" ]; then
+  if [ -z "$CZENG_FILE" ] || ([ "$CZENG_FILE" != "-" ] && [ ! -f "$CZENG_FILE" ]); then
     echo ">>> [$SCRIPT][$(date)] ERROR: None or invalid -c|--czeng option!"
     terminate
   fi
@@ -65,6 +65,11 @@ function prepare_temp() {
   TEMP_DIR=$(mktemp -d "$SCRIPT""_XXXXX")
   czeng_file_base=$(basename $CZENG_FILE)
 
+  # The CzEng file "-" is read from the standard input.
+  if [ "$CZENG_FILE" == "-" ]; then
+    czeng_file_base="stdin"
+  fi
+
   # TEMP_SORT_FILE="$TEMP_DIR"/"$czeng_file_base"_sort
   TEMP_BIN_ID_FILE="$TEMP_DIR"/"$czeng_file_base"_bin_id
   TEMP_TEXT_CS_FILE="$TEMP_DIR"/"$czeng_file_base"_text_cs
@@ -104,9 +109,12 @@ echo ">>> [$SCRIPT][$(date)] Preparing temporary folder."
 prepare_temp
 
 echo ">>> [$SCRIPT][$(date)] Preparing data."
-awk '{printf "%08d\t%d\n", (NR-1)/'$BIN_SIZE', (NR-1)}' $CZENG_FILE > $TEMP_BIN_ID_FILE
-cut -f 3 $CZENG_FILE > $TEMP_TEXT_CS_FILE
-cut -f 4 $CZENG_FILE > $TEMP_TEXT_EN_FILE
+# The CzEng file is read only once, so that it can be piped in, e.g. from czeng_clean.py -o -.
+awk -F '\t' '{
+  printf "%08d\t%d\n", (NR-1)/'$BIN_SIZE', (NR-1) > "'$TEMP_BIN_ID_FILE'"
+  print $3 > "'$TEMP_TEXT_CS_FILE'"
+  print $4 > "'$TEMP_TEXT_EN_FILE'"
+}' $CZENG_FILE
 
 echo ">>> [$SCRIPT][$(date)] Lowercasing data."
 perl -CSAD -pe '$_=lc' -i $TEMP_TEXT_CS_FILE
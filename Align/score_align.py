@@ -9,6 +9,13 @@ import time
 import math
 import operator
 
+import numpy
+import scipy.sparse as sparse
+
+import bin_join
+import doc_cache
+import weight_table
+
 
 logger_freq = 2
 logger_timestamp = time.time()
@@ -29,149 +36,173 @@ def log_minor(message, major=True):
 	logger.info(message)
 	logger_timestamp = time.time()
 
-def weight_file_iter(weight_file):
-	for line in weight_file:
+def calc_length_sims(src_doc_length, trg_doc_lengths, len_mean, len_std):
+	# Target length likelihood modeling based on normal distribution.
+	# We measure the document length difference by characters, not words.
+	# Returns the log likelihoods, one for every target document.
 
-		tokens = line.strip().split()
-		
-		src_word = tokens[0]
-		trg_word = tokens[1]
-		weight = float(tokens[2])
+	src_len = float(src_doc_length)
+	trg_lens = numpy.array(trg_doc_lengths, dtype=float)
 
-		yield((src_word, trg_word, weight))
+	log_length_sims = -(((trg_lens / src_len - len_mean) / float(len_std)) ** 2.) / 2.
+	return log_length_sims
 
-def doc_file_bin_iter(doc_file):
-	bin_, docs = None, None
+def doc_vector(doc):
+	# Document as sorted unique ids of the known words with their counts.
+	token_ids = doc[2]
 
-	for line in doc_file:
-		
-		tokens = line.strip().split("\t")
+	known_ids, counts = numpy.unique(token_ids[token_ids >= 0], return_counts=True)
+	return (known_ids, counts, len(token_ids))
 
-		doc_bin = tokens[0]
-		doc_id = tokens[1]
-		doc_text = tokens[2]
+def candidate_matrix(trg_vectors, trg_word_count):
+	# Target documents as rows of word counts.
+	ids = numpy.concatenate([trg_vector[0] for trg_vector in trg_vectors])
+	counts = numpy.concatenate([trg_vector[1] for trg_vector in trg_vectors])
+	indptr = numpy.cumsum([0] + [len(trg_vector[0]) for trg_vector in trg_vectors])
 
-		if doc_bin != bin_:
-			if bin_: yield (bin_, docs)
-			bin_, docs = doc_bin, {}
+	shape = (len(trg_vectors), trg_word_count)
+	return sparse.csr_matrix((counts.astype(float), ids, indptr), shape=shape)
 
-		docs[doc_id] = doc_text
+def calc_src_weights(src_vector, trg_vectors, weights):
+	# Same averaged weights as the nested loop over the words, but for all
+	# the candidates at once and aggregated over the unique source words and
+	# the target counts. Missing weights are null_weight, hence a source word
+	# without any weight averages to unknown_weight regardless of the target.
+	# Returns a matrix of the unique source words by the candidates.
+	src_ids, src_counts, src_size = src_vector
+	null_weight = 1e-09
 
-	if bin_: yield (bin_, docs)
+	# The source rows are looked up once, shifted so that a missing weight
+	# contributes zero, and multiplied with the counts of all the candidates.
+	src_rows = weight_table.get_rows(weights, src_ids)
+	src_rows.data -= null_weight
 
-def align_file_bin_iter(align_file):
-	bin_, aligns = None, None
+	candidates = candidate_matrix(trg_vectors, weights.shape[1])
+	matching_weights = src_rows.dot(candidates.T).toarray()
 
-	for line in align_file:
-		
-		tokens = line.strip().split("\t")
+	trg_sizes = numpy.array([trg_vector[2] for trg_vector in trg_vectors], dtype=float)
+	trg_sizes[trg_sizes == 0] = numpy.nan
 
-		align_bin = tokens[0]
-		src_doc_id = tokens[1]
-		trg_doc_id = tokens[2]
-		score = float(tokens[3])
+	src_weights = null_weight + (null_weight * trg_sizes + matching_weights) / trg_sizes
+	return src_weights
 
-		if align_bin != bin_:
-			if bin_: yield (bin_, aligns)
-			bin_, aligns = align_bin, {}
-		
-		src_aligns = aligns.get(src_doc_id, [])
-		src_aligns.append((trg_doc_id, score))
-		aligns[src_doc_id] = src_aligns
+def calc_weight_sims(src_vector, trg_vectors, weights):
+	# Logarithm of the product of the averaged weights of all the source
+	# words divided by the source length, one for every target document.
+	# The product underflows to zero on longer documents, while the average
+	# log weight stays comparable across documents of any length.
+	src_ids, src_counts, src_size = src_vector
+	null_weight = 1e-09
 
-	if bin_: yield (bin_, aligns)
+	unknown_count = src_size - src_counts.sum()
+	unknown_weight = null_weight + null_weight
 
-def calc_length_sim(src_doc_text, trg_doc_text, len_mean, len_std):
-	# Target length likelihood modeling based on normal distribution.
-	# We measure the document length difference by characters, not words.
-	
-	likelihood = lambda x, m, sd: math.exp(-(((x - m) / float(sd)) ** 2.) / 2.)
-	src_len, trg_len = float(len(src_doc_text)), float(len(trg_doc_text))
+	src_weights = calc_src_weights(src_vector, trg_vectors, weights)
+	log_weight_sims = src_counts.dot(numpy.log(src_weights)) + unknown_count * math.log(unknown_weight)
+
+	# Every source word averages to null_weight over an empty target.
+	empty = numpy.array([trg_vector[2] == 0 for trg_vector in trg_vectors])
+	log_weight_sims[empty] = src_size * math.log(null_weight)
+
+	return log_weight_sims / max(src_size, 1)
+
+def calc_linear_weight_sims(src_vector, trg_vectors, weights):
+	# Product of the averaged weights of all the source words, one for every
+	# target document, computed directly rather than through the logarithms
+	# so that the scores stay the same as those of the nested loop.
+	src_ids, src_counts, src_size = src_vector
+	null_weight = 1e-09
 
-	length_sim = likelihood(trg_len / src_len, len_mean, len_std)
-	return length_sim
+	unknown_count = src_size - src_counts.sum()
+	unknown_weight = null_weight + null_weight
 
-def calc_weight_sim(src_doc_text, trg_doc_text, weights):
-	src_words, trg_words = src_doc_text.split(), trg_doc_text.split()
-	src_size, trg_size = float(len(src_words)), float(len(trg_words))
-	null_weights, null_weight = {}, 1e-09
+	# Candidates are rows of the transposed copy, so every product runs over
+	# a contiguous array in the order of the source words.
+	candidate_weights = numpy.ascontiguousarray(calc_src_weights(src_vector, trg_vectors, weights).T)
 
-	weight_sim = 1.
-	for src_word in src_words:
-		
-		src_weight = null_weight
-		src_weights = weights.get(src_word, null_weights)
+	weight_sims = []
+	for trg_vector, src_weights in zip(trg_vectors, candidate_weights):
 
-		for trg_word in trg_words:
-			weight = src_weights.get(trg_word, null_weight)
-			src_weight += weight / trg_size
+		# Every source word averages to null_weight over an empty target.
+		if trg_vector[2] == 0:
+			weight_sims.append(null_weight ** src_size)
+			continue
 
-		weight_sim *= src_weight
+		weight_sim = numpy.prod(src_weights ** src_counts) * unknown_weight ** unknown_count
+		weight_sims.append(float(weight_sim))
 
-	return weight_sim
+	return weight_sims
 
-def score_align(align_file, src_doc_file, trg_doc_file, len_mean, len_std, weight_file, output_file):
+def score_candidates(src_doc_length, src_vector, trg_doc_lengths, trg_vectors, weights, len_mean, len_std, log_space):
+	# Scores all the candidates of a source document at once.
+	if not trg_vectors: return []
+
+	log_length_sims = calc_length_sims(src_doc_length, trg_doc_lengths, len_mean, len_std)
+
+	if log_space:
+		log_weight_sims = calc_weight_sims(src_vector, trg_vectors, weights)
+		return (log_length_sims + log_weight_sims).tolist()
+
+	# The original score is the product of the linear similarities.
+	length_sims = [math.exp(log_length_sim) for log_length_sim in log_length_sims.tolist()]
+	weight_sims = calc_linear_weight_sims(src_vector, trg_vectors, weights)
+	return [length_sim * weight_sim for length_sim, weight_sim in zip(length_sims, weight_sims)]
+
+def score_align(align_file, src_doc_path, trg_doc_path, len_mean, len_std, weight_path, log_space, output_file):
 	# WARNING: Bidirectional weigths decrease precision!
 	# Bidirectional weights seem like a good idea but they are not.
+	# In log space the score is the log length similarity plus the average
+	# log weight of the source words, so the scores are negative.
 
 	log_major("Loading weights ...")
 
-	weights = {}
-
-	weight_index = 0
-	for src_word, trg_word, weight in weight_file_iter(weight_file):
+	word_ids, weights = weight_table.load_weights(weight_path)
 
-		weight_index += 1
-		log_minor("Loading weight %s." % weight_index)
+	log_major("Weights loaded.")
+	log_major("Loading doc caches ...")
 
-		src_weights = weights.get(src_word, {})
-		weights[src_word] = src_weights
-		src_weights[trg_word] = weight
+	src_cache_file, src_bin_iter = doc_cache.open_cache(src_doc_path, word_ids)
+	trg_cache_file, trg_bin_iter = doc_cache.open_cache(trg_doc_path, word_ids)
 
-	log_major("Weights loaded.")
+	log_major("Doc caches loaded.")
 	log_major("Scoring bins ...")
 
-	align_bin_iter = align_file_bin_iter(align_file)
-	src_bin_iter = doc_file_bin_iter(src_doc_file)
-	trg_bin_iter = doc_file_bin_iter(trg_doc_file)
-	align_item, src_item, trg_item = None, None, None
+	align_bin_iter = bin_join.file_bin_iter(align_file)
 
 	align_index = 0
-	while True:
-
-		if not align_item: align_item = next(align_bin_iter, None)
-		if not src_item: src_item = next(src_bin_iter, None)
-		if not trg_item: trg_item = next(trg_bin_iter, None)
-		if not align_item or not src_item or not trg_item: break
+	bin_iter = bin_join.join_bins(align_bin_iter, src_bin_iter, trg_bin_iter)
+	for align_bin, (align_lines, src_docs_loader, trg_docs_loader) in bin_iter:
 
-		align_bin, aligns = align_item
-		src_bin, src_docs = src_item
-		trg_bin, trg_docs = trg_item
-
-		if align_bin < max(src_bin, trg_bin): align_item = None
-		if src_bin < max(align_bin, trg_bin): src_item = None
-		if trg_bin < max(align_bin, src_bin): trg_item = None
-		if not align_bin == src_bin == trg_bin: continue
+		aligns = bin_join.read_aligns(align_lines)
+		src_docs = src_docs_loader()
+		trg_docs = trg_docs_loader()
 
 		log_major("Scoring bin '%s' ..." % align_bin)
 
+		# Every target document is converted only once per bin.
+		trg_vectors = {}
+
 		for src_doc_id, src_aligns in aligns.items():
 
 			align_index += 1
 			log_minor("Scoring alignment %s." % align_index)
 
-			new_src_aligns = []
-			src_doc_text = src_docs[src_doc_id]
+			src_doc = src_docs[src_doc_id]
+			src_vector = doc_vector(src_doc)
 
-			for trg_doc_id, score in src_aligns:
+			trg_doc_ids = [trg_doc_id for trg_doc_id, score in src_aligns]
+			trg_doc_lengths = [trg_docs[trg_doc_id][1] for trg_doc_id in trg_doc_ids]
 
-				trg_doc_text = trg_docs[trg_doc_id]
+			for trg_doc_id in trg_doc_ids:
+				if trg_doc_id not in trg_vectors:
+					trg_vectors[trg_doc_id] = doc_vector(trg_docs[trg_doc_id])
 
-				length_sim = calc_length_sim(src_doc_text, trg_doc_text, len_mean, len_std)
-				weight_sim = calc_weight_sim(src_doc_text, trg_doc_text, weights)
-				new_score = length_sim * weight_sim
+			new_scores = score_candidates(src_doc[1], src_vector,
+				trg_doc_lengths, [trg_vectors[trg_doc_id] for trg_doc_id in trg_doc_ids],
+				weights, len_mean, len_std, log_space)
 
-				new_src_aligns.append((src_bin, src_doc_id, trg_doc_id, new_score))
+			new_src_aligns = [(align_bin, src_doc_id, trg_doc_id, new_score)
+				for trg_doc_id, new_score in zip(trg_doc_ids, new_scores)]
 
 			new_src_aligns.sort(key=operator.itemgetter(3), reverse=True)
 
@@ -182,7 +213,8 @@ def score_align(align_file, src_doc_file, trg_doc_file, len_mean, len_std, weigh
 
 		log_major("Bin '%s' scored." % align_bin)
 
-		align_item, src_item, trg_item = None, None, None
+	src_cache_file.close()
+	trg_cache_file.close()
 
 	log_major("All bins scored.")
 
@@ -198,6 +230,7 @@ if __name__ == "__main__":
 	parser.add_argument('-m', '--len_mean', type=float, default=1.0)
 	parser.add_argument('-d', '--len_std', type=float, default=0.5)
 	parser.add_argument('-w', '--weight', required=True, type=str)
+	parser.add_argument('-l', '--log_space', action='store_true', default=False)
 	parser.add_argument('-o', '--output', required=True, type=str)
 	args = parser.parse_args()
 
@@ -205,21 +238,15 @@ if __name__ == "__main__":
 	for arg in vars(args): log_major("Option --%s = %s." % (arg, getattr(args, arg)))
 
 	align_file = codecs.open(args.align, "r", "utf-8")
-	src_doc_file = codecs.open(args.src_doc, "r", "utf-8")
-	trg_doc_file = codecs.open(args.trg_doc, "r", "utf-8")
-	weight_file = codecs.open(args.weight, "r", "utf-8")
 	output_file = codecs.open(args.output, "w", "utf-8")
 
 	try:
-		score_align(align_file, src_doc_file, trg_doc_file, 
-			args.len_mean, args.len_std, weight_file, output_file)
+		score_align(align_file, args.src_doc, args.trg_doc, 
+			args.len_mean, args.len_std, args.weight, args.log_space, output_file)
 
 		log_major("Script ended successfully.")
 	except:
 		log_major("Script ended unsucessfully!")
 	finally:
 		align_file.close()
-		src_doc_file.close()
-		trg_doc_file.close()
-		weight_file.close()
 		output_file.close()
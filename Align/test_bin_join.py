@@ -0,0 +1,111 @@
+import io
+import signal
+import unittest
+
+import bin_join
+import bench_align
+
+
+def lines_of(bins):
+	# Lines of a bin-sorted file, bins is a list of (bin, [doc_id, ...]).
+	return [u"%s\t%s\ttext of %s\n" % (bin_, doc_id, doc_id) for bin_, doc_ids in bins for doc_id in doc_ids]
+
+def doc_ids_of(lines):
+	return [line.split("\t")[1] for line in lines]
+
+def joined(*files):
+	bin_iters = [bin_join.file_bin_iter(lines) for lines in files]
+	return [(bin_, [doc_ids_of(payload) for payload in payloads]) for bin_, payloads in bin_join.join_bins(*bin_iters)]
+
+class ListFile(list):
+	def write(self, text): self.append(text)
+
+
+class TimeoutTestCase(unittest.TestCase):
+	# Fails a test that does not finish in a few seconds instead of hanging.
+
+	def setUp(self):
+		def on_alarm(signum, frame): raise AssertionError("Test timed out.")
+		self.previous_handler = signal.signal(signal.SIGALRM, on_alarm)
+		signal.alarm(5)
+
+	def tearDown(self):
+		signal.alarm(0)
+		signal.signal(signal.SIGALRM, self.previous_handler)
+
+
+class FileBinIterTest(TimeoutTestCase):
+
+	def test_groups_lines_by_bin(self):
+		lines = lines_of([("00000000", ["a", "b"]), ("00000001", ["c"])])
+		bins = [(bin_, doc_ids_of(bin_lines)) for bin_, bin_lines in bin_join.file_bin_iter(lines)]
+		self.assertEqual(bins, [("00000000", ["a", "b"]), ("00000001", ["c"])])
+
+	def test_skipped_bin_ids(self):
+		lines = lines_of([("00000000", ["a"]), ("00000003", ["b", "c"]), ("00000007", ["d"])])
+		bins = [(bin_, doc_ids_of(bin_lines)) for bin_, bin_lines in bin_join.file_bin_iter(lines)]
+		self.assertEqual(bins, [("00000000", ["a"]), ("00000003", ["b", "c"]), ("00000007", ["d"])])
+
+	def test_empty_input(self):
+		self.assertEqual(list(bin_join.file_bin_iter([])), [])
+		self.assertEqual(list(bin_join.file_bin_iter(io.StringIO(u""))), [])
+
+
+class JoinBinsTest(TimeoutTestCase):
+
+	def test_matching_bins(self):
+		src = lines_of([("00000000", ["a"]), ("00000001", ["b"])])
+		trg = lines_of([("00000000", ["c"]), ("00000001", ["d"])])
+		self.assertEqual(joined(src, trg), [("00000000", [["a"], ["c"]]), ("00000001", [["b"], ["d"]])])
+
+	def test_bins_on_one_side_only(self):
+		src = lines_of([("00000000", ["a"]), ("00000001", ["b"]), ("00000003", ["c"])])
+		trg = lines_of([("00000001", ["d"]), ("00000002", ["e"]), ("00000003", ["f"]), ("00000004", ["g"])])
+		self.assertEqual(joined(src, trg), [("00000001", [["b"], ["d"]]), ("00000003", [["c"], ["f"]])])
+		self.assertEqual(joined(trg, src), [("00000001", [["d"], ["b"]]), ("00000003", [["f"], ["c"]])])
+
+	def test_skipped_bin_ids(self):
+		src = lines_of([("00000000", ["a"]), ("00000005", ["b"]), ("00000009", ["c"])])
+		trg = lines_of([("00000002", ["d"]), ("00000005", ["e"]), ("00000008", ["f"]), ("00000009", ["g"])])
+		self.assertEqual(joined(src, trg), [("00000005", [["b"], ["e"]]), ("00000009", [["c"], ["g"]])])
+
+	def test_no_common_bins(self):
+		src = lines_of([("00000000", ["a"]), ("00000002", ["b"])])
+		trg = lines_of([("00000001", ["c"]), ("00000003", ["d"])])
+		self.assertEqual(joined(src, trg), [])
+
+	def test_three_iterators(self):
+		align = lines_of([("00000000", ["a"]), ("00000001", ["b"]), ("00000002", ["c"])])
+		src = lines_of([("00000001", ["d"]), ("00000002", ["e"])])
+		trg = lines_of([("00000000", ["f"]), ("00000002", ["g"])])
+		self.assertEqual(joined(align, src, trg), [("00000002", [["c"], ["e"], ["g"]])])
+
+	def test_empty_inputs(self):
+		docs = lines_of([("00000000", ["a"])])
+		self.assertEqual(joined([], []), [])
+		self.assertEqual(joined(docs, []), [])
+		self.assertEqual(joined([], docs), [])
+		self.assertEqual(list(bin_join.join_bins()), [])
+
+
+class BenchAlignTest(TimeoutTestCase):
+
+	def test_bins_missing_in_the_docs(self):
+		# bench_align.py used to loop forever once the align file and the
+		# doc file had different bins.
+		align_lines = [
+			u"00000000\ta\ta\t0.9\n",
+			u"00000001\tb\tb\t0.9\n", u"00000001\tb\tc\t0.1\n",
+			u"00000003\td\tx\t0.8\n", u"00000003\td\td\t0.2\n",
+		]
+		trg_lines = lines_of([("00000001", ["b", "c"]), ("00000002", ["e"]), ("00000003", ["d", "x"])])
+
+		output_file = ListFile()
+		bench_align.bench_align(align_lines, trg_lines, output_file)
+
+		results = sorted(line.strip().split("\t") for line in output_file)
+		self.assertEqual(results, [["0", "1"], ["1", "1"]])
+
+
+if __name__ == "__main__":
+	unittest.main()
@@ -9,16 +9,27 @@ import time
 import math
 import random
 import operator
-import pickle
 
+import numpy
 from sklearn import tree
 
+import bin_join
+import doc_cache
+import feature_store
+import flat_tree
+import ordered_pool
+import weight_table
+
 
 logger_freq = 2
 logger_timestamp = time.time()
 logger = logging.getLogger(__file__)
 logging.getLogger().handlers = []
 
+worker_weights = None
+worker_len_mean = None
+worker_len_std = None
+
 def log_major(message):
 	global logger_timestamp
 	
@@ -34,89 +45,30 @@ def log_minor(message, major=True):
 	logger.info(message)
 	logger_timestamp = time.time()
 
-def weight_file_iter(weight_file):
-	for line in weight_file:
-
-		tokens = line.strip().split()
-		
-		src_word = tokens[0]
-		trg_word = tokens[1]
-		weight = float(tokens[2])
-
-		yield((src_word, trg_word, weight))
-
-def doc_file_bin_iter(doc_file):
-	bin_, docs = None, None
-
-	for line in doc_file:
-		
-		tokens = line.strip().split("\t")
-
-		doc_bin = tokens[0]
-		doc_id = tokens[1]
-		doc_text = tokens[2]
-
-		if doc_bin != bin_:
-			if bin_: yield (bin_, docs)
-			bin_, docs = doc_bin, {}
-
-		docs[doc_id] = doc_text
-
-	if bin_: yield (bin_, docs)
-
-def align_file_bin_iter(align_file):
-	bin_, aligns = None, None
-
-	for line in align_file:
-		
-		tokens = line.strip().split("\t")
-
-		align_bin = tokens[0]
-		src_doc_id = tokens[1]
-		trg_doc_id = tokens[2]
-		score = float(tokens[3])
-
-		if align_bin != bin_:
-			if bin_: yield (bin_, aligns)
-			bin_, aligns = align_bin, {}
-		
-		src_aligns = aligns.get(src_doc_id, [])
-		src_aligns.append((trg_doc_id, score))
-		aligns[src_doc_id] = src_aligns
-
-	if bin_: yield (bin_, aligns)
-
-def calc_length_sim(src_doc_text, trg_doc_text, len_mean, len_std):
+def calc_length_sim(src_doc, trg_doc, len_mean, len_std):
 	# Target length likelihood modeling based on normal distribution.
 	# We measure the document length difference by characters, not words.
 	
 	likelihood = lambda x, m, sd: math.exp(-(((x - m) / float(sd)) ** 2.) / 2.)
-	src_length, trg_length = float(len(src_doc_text)), float(len(trg_doc_text))
+	src_length, trg_length = float(src_doc[1]), float(trg_doc[1])
 
 	length_sim = likelihood(trg_length / src_length, len_mean, len_std)
 	length_conf = 1. - math.exp(-0.01 * src_length)
 	return (length_sim, length_conf)
 
-def calc_weight_sim(src_doc_text, trg_doc_text, weights):
-	src_words, trg_words = src_doc_text.split(), trg_doc_text.split()
-	src_size, trg_size = float(len(src_words)), float(len(trg_words))
-	null_weights = {}
+def calc_weight_sim(src_doc, trg_doc, weights):
+	src_ids, src_word_lengths = src_doc[2], src_doc[3]
+	src_max_weights = weight_table.calc_max_weights(weights, src_ids, trg_doc[2])
 
 	total_length = 0.
 	resolved_length = 0.
 	matching_length = 0.
 
-	for src_word in src_words:
-
-		src_max_weight = None
-		src_weights = weights.get(src_word, null_weights)
+	for src_id, src_word_length in zip(src_ids.tolist(), src_word_lengths.tolist()):
 
-		for trg_word in trg_words:	
-			weight = src_weights.get(trg_word, None)
-			if not weight and trg_word == src_word: weight = 1.
-			src_max_weight = max(weight, src_max_weight)
+		src_max_weight = src_max_weights[src_id]
 
-		src_word_length = float(len(src_word))
+		src_word_length = float(src_word_length)
 		total_length += src_word_length
 
 		if src_max_weight:
@@ -127,73 +79,58 @@ def calc_weight_sim(src_doc_text, trg_doc_text, weights):
 	weight_conf = resolved_length / total_length if total_length > 0. else 0.
 	return (weight_sim, weight_conf)
 
-def train_classifier(align_file, src_doc_file, trg_doc_file, len_mean, len_std, weight_file, output):
-	# Classification with Feed-Forward Neural Networks.
-	# http://pybrain.org/docs/tutorial/fnn.html
+def init_worker(weights, len_mean, len_std):
+	global worker_weights, worker_len_mean, worker_len_std
 
-	log_major("Loading weights ...")
+	worker_weights = weights
+	worker_len_mean, worker_len_std = len_mean, len_std
 
-	weights = {}
+def prepare_bin(bin_item):
+	# Only the features are computed in the workers, the samples are chosen
+	# beforehand, so the data do not depend on the number of workers.
+	align_bin, samples, src_docs, trg_docs = bin_item
 
-	weight_index = 0
-	for src_word, trg_word, weight in weight_file_iter(weight_file):
+	bin_inps = []
+	for src_doc_id, trg_doc_id, out in samples:
 
-		weight_index += 1
-		log_minor("Loading weight %s." % weight_index)
+		src_doc, trg_doc = src_docs[src_doc_id], trg_docs[trg_doc_id]
 
-		src_weights = weights.get(src_word, {})
-		weights[src_word] = src_weights
-		src_weights[trg_word] = weight
+		length_sim, length_conf = calc_length_sim(src_doc, trg_doc, worker_len_mean, worker_len_std)
+		weight_sim, weight_conf = calc_weight_sim(src_doc, trg_doc, worker_weights)
 
-	log_major("Weights loaded.")
-	log_major("Preparing bins ...")
+		bin_inps.append([length_sim, length_conf, weight_sim, weight_conf])
 
-	align_bin_iter = align_file_bin_iter(align_file)
-	src_bin_iter = doc_file_bin_iter(src_doc_file)
-	trg_bin_iter = doc_file_bin_iter(trg_doc_file)
-	align_item, src_item, trg_item = None, None, None
+	return (align_bin, samples, bin_inps)
 
+def sampled_bin_iter(bin_iter, rng):
 	subsampling, sample_pos_ratio = 0.2, 0.5
 	sample_neg_ratio = 1. - sample_pos_ratio
 
 	seen_positives, seen_negatives = 1e-9, 1e-9
-	all_data = []
 
 	align_index = 0
-	while True:
+	for align_bin, (align_lines, src_docs_loader, trg_docs_loader) in bin_iter:
 
-		if not align_item: align_item = next(align_bin_iter, None)
-		if not src_item: src_item = next(src_bin_iter, None)
-		if not trg_item: trg_item = next(trg_bin_iter, None)
-		if not align_item or not src_item or not trg_item: break
+		aligns = bin_join.read_aligns(align_lines)
+		src_docs = src_docs_loader()
+		trg_docs = trg_docs_loader()
 
-		align_bin, aligns = align_item
-		src_bin, src_docs = src_item
-		trg_bin, trg_docs = trg_item
-
-		if align_bin < max(src_bin, trg_bin): align_item = None
-		if src_bin < max(align_bin, trg_bin): src_item = None
-		if trg_bin < max(align_bin, src_bin): trg_item = None
-		if not align_bin == src_bin == trg_bin: continue
-
-		log_major("Preparing bin '%s' ..." % align_bin)
+		log_major("Sampling bin '%s' ..." % align_bin)
 
+		samples = []
 		for src_doc_id, src_aligns in aligns.items():
 
 			align_index += 1
-			log_minor("Preparing data %s." % align_index)
+			log_minor("Sampling data %s." % align_index)
 
 			src_aligns.sort(key=operator.itemgetter(1), reverse=True)
-			src_doc_text = src_docs[src_doc_id]
-			corr_doc_text = trg_docs[src_doc_id]
-			corr_doc_hash = hash(corr_doc_text)
+			corr_doc_hash = trg_docs[src_doc_id][0]
 
 			mindex = None
 			for index in range(len(src_aligns)):
 
 				trg_doc_id = src_aligns[index][0]
-				trg_doc_text = trg_docs[trg_doc_id]
-				trg_doc_hash = hash(trg_doc_text)
+				trg_doc_hash = trg_docs[trg_doc_id][0]
 
 				if trg_doc_hash == corr_doc_hash:
 					mindex = index
@@ -205,59 +142,160 @@ def train_classifier(align_file, src_doc_file, trg_doc_file, len_mean, len_std,
 			if mindex == 0 or mindex == None:
 				seen_pos_ratio = seen_positives / (seen_positives + seen_negatives)
 				pos_probab = subsampling * sample_pos_ratio / seen_pos_ratio
-				if mindex == 0 and random.random() > pos_probab: continue
+				if mindex == 0 and rng.random() > pos_probab: continue
 
 				seen_neg_ratio = seen_negatives / (seen_negatives + seen_positives)
 				neg_probab = subsampling * sample_neg_ratio / seen_neg_ratio
-				if mindex == None and random.random() > neg_probab: continue
+				if mindex == None and rng.random() > neg_probab: continue
 
 				top_src_align = src_aligns[0]
 				trg_doc_id = top_src_align[0]
-				trg_doc_text = trg_docs[trg_doc_id]
 
-				length_sim, length_conf = calc_length_sim(src_doc_text, trg_doc_text, len_mean, len_std)
-				weight_sim, weight_conf = calc_weight_sim(src_doc_text, trg_doc_text, weights)
-				
-				inp = [length_sim, length_conf, weight_sim, weight_conf]
 				out = 1 if mindex == 0 else 0
-				all_data.append((inp, out))
+				samples.append((src_doc_id, trg_doc_id, out))
+
+		# Only the sampled documents are passed on to the workers.
+		sample_src_docs = dict((src_doc_id, src_docs[src_doc_id]) for src_doc_id, _, _ in samples)
+		sample_trg_docs = dict((trg_doc_id, trg_docs[trg_doc_id]) for _, trg_doc_id, _ in samples)
+
+		yield (align_bin, samples, sample_src_docs, sample_trg_docs)
+
+def prepared_bin_iter(bin_items, weights, len_mean, len_std, workers):
+	# The weights are inherited by the forked workers, not copied.
+	init_args = (weights, len_mean, len_std)
+	return ordered_pool.ordered_map(prepare_bin, bin_items, workers, init_worker, init_args)
+
+def calc_precision_recall(confidences, outs, confidence):
+	# Precision and recall of accepting the confidences higher than the
+	# threshold, for every distinct confidence and the given one as the
+	# threshold. Precision of accepting nothing is taken as 1.
+	thresholds = numpy.union1d(confidences, [confidence])
+
+	order = numpy.argsort(confidences, kind="mergesort")
+	sorted_confidences, sorted_outs = confidences[order], outs[order]
+
+	# Positives among the confidences from the given index on.
+	positives_from = numpy.append(numpy.cumsum(sorted_outs[::-1])[::-1], 0)
+
+	accepted_from = numpy.searchsorted(sorted_confidences, thresholds, side="right")
+	accepted = len(confidences) - accepted_from
+	true_accepted = positives_from[accepted_from].astype(float)
+
+	precisions = numpy.where(accepted > 0, true_accepted / numpy.maximum(accepted, 1), 1.)
+	recalls = true_accepted / max(positives_from[0], 1)
+	return (thresholds, precisions, recalls)
+
+def extract_data(align_path, src_doc_path, trg_doc_path, len_mean, len_std, weight_path, seed, workers, store):
+	# Returns the feature rows and the labels of the sampled alignments,
+	# which are also appended to the feature store, if there is one.
+
+	log_major("Loading weights ...")
+
+	word_ids, weights = weight_table.load_weights(weight_path)
+
+	log_major("Weights loaded.")
+	log_major("Loading doc caches ...")
+
+	src_cache_file, src_bin_iter = doc_cache.open_cache(src_doc_path, word_ids)
+	trg_cache_file, trg_bin_iter = doc_cache.open_cache(trg_doc_path, word_ids)
+
+	log_major("Doc caches loaded.")
+	log_major("Preparing bins ...")
+
+	align_file = codecs.open(align_path, "r", "utf-8")
+	align_bin_iter = bin_join.file_bin_iter(align_file)
+
+	# All the sampling decisions are made in this process by a single
+	# generator, so that a seed reproduces the results for any workers.
+	rng = random.Random(seed)
+	all_inps, all_outs = [], []
+
+	bin_iter = bin_join.join_bins(align_bin_iter, src_bin_iter, trg_bin_iter)
+	bin_items = sampled_bin_iter(bin_iter, rng)
+
+	for align_bin, samples, bin_inps in prepared_bin_iter(bin_items, weights, len_mean, len_std, workers):
+
+		bin_outs = [out for _, _, out in samples]
+		all_inps.extend(bin_inps)
+		all_outs.extend(bin_outs)
+
+		if store:
+			bin_aligns = [(align_bin, src_doc_id, trg_doc_id) for src_doc_id, trg_doc_id, _ in samples]
+			feature_store.append_chunk(store, bin_aligns, bin_inps, bin_outs)
 
 		log_major("Bin '%s' prepared." % align_bin)
 
-		align_item, src_item, trg_item = None, None, None
+	align_file.close()
+	src_cache_file.close()
+	trg_cache_file.close()
 
 	log_major("All bins prepared.")
+	return (numpy.array(all_inps), numpy.array(all_outs))
+
+def train_classifier(align_path, src_doc_path, trg_doc_path, len_mean, len_std, weight_path, seed, workers, confidence, pr_curve, store_path, output):
+	# Features are extracted only if there is no feature store to reuse.
+	store_meta = {"align": align_path, "src_doc": src_doc_path, "trg_doc": trg_doc_path,
+		"len_mean": len_mean, "len_std": len_std, "weight": weight_path, "seed": seed}
+	input_paths = [align_path, src_doc_path, trg_doc_path, weight_path]
+
+	if store_path and feature_store.store_valid(store_path, store_meta, input_paths):
+		log_major("Loading feature store ...")
+		all_inps, all_outs = feature_store.load_data(store_path)
+		log_major("Feature store loaded.")
+	else:
+		store = feature_store.create_store(store_path, store_meta) if store_path else None
+		all_inps, all_outs = extract_data(align_path, src_doc_path, trg_doc_path,
+			len_mean, len_std, weight_path, seed, workers, store)
+		if store: feature_store.close_store(store)
+
 	log_major("Training classifier.")
 
-	train_data, test_data = [], []
+	# The split has its own generator, so it is the same whether the
+	# features were extracted or loaded from the feature store.
+	split_rng = numpy.random.RandomState(seed)
+	train_mask = split_rng.random_sample(len(all_outs)) > 0.8
+
+	train_inps, train_outs = all_inps[train_mask], all_outs[train_mask]
+	test_inps, test_outs = all_inps[~train_mask], all_outs[~train_mask]
 
-	for inp, out in all_data:
-		data = train_data if random.random() > 0.8 else test_data
-		data.append((inp, out))
+	clf = tree.DecisionTreeClassifier(max_leaf_nodes=100, random_state=seed)
+	clf = clf.fit(train_inps, train_outs)
 
-	clf = tree.DecisionTreeClassifier(max_leaf_nodes=100)
-	clf = clf.fit(zip(*train_data)[0], zip(*train_data)[1])
+	# Small or heavily filtered inputs may sample a single class only.
+	if len(clf.classes_) < 2:
+		log_major("Training data contain only class %s." % clf.classes_[0])
 
-	train_errors = 0.
-	for inp, out in train_data:
-		val = clf.predict([inp])[0]
-		train_errors += val != out
+	# The tree is flattened, apply_tree.py evaluates it without sklearn.
+	clf_tree = flat_tree.export_tree(clf)
 
-	test_errors = 0.
-	for inp, out in test_data:
-		val = clf.predict([inp])[0]
-		test_errors += val != out
+	train_errors = float(numpy.sum(clf.predict(train_inps) != train_outs))
+	test_errors = float(numpy.sum(clf.predict(test_inps) != test_outs))
 
-	train_error = 100. * train_errors / len(train_data)
-	test_error = 100. * test_errors / len(test_data)
+	train_error = 100. * train_errors / len(train_outs)
+	test_error = 100. * test_errors / len(test_outs)
 
 	log_major("Training data error: %5.2f %%." % train_error)
 	log_major("Testing data error: %5.2f %%." % test_error)
 
+	# The curve is evaluated on the testing data with the same rule as in
+	# apply_tree.py, an alignment is accepted if its confidence is higher.
+	test_confidences = flat_tree.predict_proba(clf_tree, test_inps)
+	thresholds, precisions, recalls = calc_precision_recall(test_confidences, test_outs, confidence)
+
+	confidence_index = numpy.searchsorted(thresholds, confidence)
+	log_major("Testing data precision: %5.2f %% (confidence %s)." % (100. * precisions[confidence_index], confidence))
+	log_major("Testing data recall: %5.2f %% (confidence %s)." % (100. * recalls[confidence_index], confidence))
+
+	if pr_curve:
+		pr_curve_file = open(pr_curve, "w")
+		for threshold, precision, recall in zip(thresholds.tolist(), precisions.tolist(), recalls.tolist()):
+			pr_curve_file.write("%s\t%s\t%s\n" % (threshold, precision, recall))
+		pr_curve_file.close()
+
 	log_major("Classifier trained.")	
 	log_major("Saving classifier ...")
 
-	pickle.dump(clf, open(output, 'wb'))
+	flat_tree.save_tree(clf_tree, output)
 
 	log_major("Classifier saved.")
 
@@ -273,26 +311,22 @@ if __name__ == "__main__":
 	parser.add_argument('-m', '--len_mean', type=float, default=1.0)
 	parser.add_argument('-d', '--len_std', type=float, default=0.5)
 	parser.add_argument('-w', '--weight', required=True, type=str)
+	parser.add_argument('-sd', '--seed', type=int, default=None)
+	parser.add_argument('-p', '--workers', type=int, default=1)
+	parser.add_argument('-f', '--confidence', type=float, default=0.5)
+	parser.add_argument('-pr', '--pr_curve', type=str, default=None)
+	parser.add_argument('-fs', '--feature_store', type=str, default=None)
 	parser.add_argument('-o', '--output', required=True, type=str)
 	args = parser.parse_args()
 
 	log_major("Starting execution in %s." % os.getcwd())
 	for arg in vars(args): log_major("Option --%s = %s." % (arg, getattr(args, arg)))
 
-	align_file = codecs.open(args.align, "r", "utf-8")
-	src_doc_file = codecs.open(args.src_doc, "r", "utf-8")
-	trg_doc_file = codecs.open(args.trg_doc, "r", "utf-8")
-	weight_file = codecs.open(args.weight, "r", "utf-8")
-
 	try:
-		train_classifier(align_file, src_doc_file, trg_doc_file, 
-			args.len_mean, args.len_std, weight_file, args.output)
+		train_classifier(args.align, args.src_doc, args.trg_doc, 
+			args.len_mean, args.len_std, args.weight, args.seed, args.workers,
+			args.confidence, args.pr_curve, args.feature_store, args.output)
 
 		log_major("Script ended successfully.")
 	except:
 		log_major("Script ended unsucessfully!")
-	finally:
-		align_file.close()
-		src_doc_file.close()
-		trg_doc_file.close()
-		weight_file.close()
@@ -0,0 +1,162 @@
+import os
+import codecs
+import array
+
+import numpy
+import scipy.sparse as sparse
+
+
+# Translation table store, created by convert_weight.py next to the weight
+# file (the GIZA all.param file with "src_word trg_word weight" lines):
+#
+#   <weight>.vocab        words of both languages, one per line, by their id
+#   <weight>.indptr.npy   CSR row pointers, one row per source word id
+#   <weight>.indices.npy  CSR column indices, the target word ids
+#   <weight>.data.npy     CSR values, the float64 weights
+#
+# The vocabulary is shared by both languages, so that a word has the same
+# id on either side. The arrays are memory-mapped, so the store loads
+# almost instantly and the OS shares its pages among the processes.
+# http://docs.scipy.org/doc/numpy/neps/npy-format.html
+
+store_suffixes = [".vocab", ".indptr.npy", ".indices.npy", ".data.npy"]
+
+def weight_file_iter(weight_file):
+	for line in weight_file:
+
+		tokens = line.strip().split()
+
+		src_word = tokens[0]
+		trg_word = tokens[1]
+		weight = float(tokens[2])
+
+		yield((src_word, trg_word, weight))
+
+def store_exists(weight_path):
+	# A store older than the weight file is considered stale and is ignored.
+	store_paths = [weight_path + suffix for suffix in store_suffixes]
+	if not all(os.path.isfile(store_path) for store_path in store_paths): return False
+
+	weight_mtime = os.path.getmtime(weight_path)
+	return min(os.path.getmtime(store_path) for store_path in store_paths) >= weight_mtime
+
+def read_weight_file(weight_file):
+	# Returns the vocabulary and the weights as a CSR matrix. Typed arrays
+	# avoid a Python object for every weight read.
+	word_ids, words = {}, []
+	src_ids, trg_ids, values = array.array('l'), array.array('l'), array.array('d')
+
+	for src_word, trg_word, weight in weight_file_iter(weight_file):
+
+		for word in (src_word, trg_word):
+			if word in word_ids: continue
+			word_ids[word] = len(words)
+			words.append(word)
+
+		src_ids.append(word_ids[src_word])
+		trg_ids.append(word_ids[trg_word])
+		values.append(weight)
+
+	src_ids = numpy.frombuffer(src_ids, dtype=numpy.dtype('l')).astype(numpy.int64)
+	trg_ids = numpy.frombuffer(trg_ids, dtype=numpy.dtype('l')).astype(numpy.int64)
+	values = numpy.frombuffer(values, dtype=numpy.float64)
+
+	# The last occurrence of a repeated word pair wins, as it did in a dict.
+	pair_ids = src_ids * len(words) + trg_ids
+	_, last_indices = numpy.unique(pair_ids[::-1], return_index=True)
+	last_indices = len(pair_ids) - 1 - last_indices
+
+	shape = (len(words), len(words))
+	weights = sparse.csr_matrix((values[last_indices], (src_ids[last_indices], trg_ids[last_indices])), shape=shape)
+	weights.sort_indices()
+	return (words, weights)
+
+def write_store(output, words, weights):
+	vocab_file = codecs.open(output + ".vocab", "w", "utf-8")
+	for word in words: vocab_file.write("%s\n" % word)
+	vocab_file.close()
+
+	# SciPy keeps 32-bit indices as they are, while 64-bit ones would be
+	# copied into memory whenever their values fit into 32 bits.
+	index_dtype = numpy.int32 if max(weights.nnz, len(words)) < 2 ** 31 else numpy.int64
+	numpy.save(output + ".indptr.npy", weights.indptr.astype(index_dtype))
+	numpy.save(output + ".indices.npy", weights.indices.astype(index_dtype))
+	numpy.save(output + ".data.npy", weights.data.astype(numpy.float64))
+
+def load_store(weight_path):
+	indptr = numpy.load(weight_path + ".indptr.npy", mmap_mode="r")
+	indices = numpy.load(weight_path + ".indices.npy", mmap_mode="r")
+	data = numpy.load(weight_path + ".data.npy", mmap_mode="r")
+
+	vocab_file = codecs.open(weight_path + ".vocab", "r", "utf-8")
+	words = vocab_file.read().split("\n")[:len(indptr) - 1]
+	vocab_file.close()
+
+	shape = (len(words), len(words))
+	weights = sparse.csr_matrix((data, indices, indptr), shape=shape, copy=False)
+	return (dict(zip(words, range(len(words)))), weights)
+
+def load_weights(weight_path):
+	# Returns the word ids and the weight matrix, indexed by the source word
+	# id and the target word id. The weight file is parsed only if there is
+	# no up-to-date store.
+	if store_exists(weight_path): return load_store(weight_path)
+
+	weight_file = codecs.open(weight_path, "r", "utf-8")
+	words, weights = read_weight_file(weight_file)
+	weight_file.close()
+
+	return (dict(zip(words, range(len(words)))), weights)
+
+def lookup(weights, src_id, trg_id, default=None):
+	# Weight of a single word pair, default if there is none.
+	if src_id < 0 or trg_id < 0: return default
+
+	row_start, row_end = weights.indptr[src_id], weights.indptr[src_id + 1]
+	position = row_start + numpy.searchsorted(weights.indices[row_start:row_end], trg_id)
+
+	if position == row_end or weights.indices[position] != trg_id: return default
+	return float(weights.data[position])
+
+def get_rows(weights, src_ids):
+	# Weight rows of the given source word ids, in their order.
+	return weights[numpy.asarray(src_ids, dtype=numpy.int64)]
+
+def match_rows(weights, src_ids, trg_ids):
+	# Finds the weights of the source words having one of the sorted unique
+	# target word ids. Returns the row of every weight found, the position
+	# of its target word in trg_ids and the weight itself.
+	src_rows = get_rows(weights, src_ids)
+	entry_rows = numpy.repeat(numpy.arange(len(src_ids)), numpy.diff(src_rows.indptr))
+	if len(trg_ids) == 0 or len(entry_rows) == 0: return (entry_rows[:0], entry_rows[:0], src_rows.data[:0])
+
+	positions = numpy.minimum(numpy.searchsorted(trg_ids, src_rows.indices), len(trg_ids) - 1)
+	matching = trg_ids[positions] == src_rows.indices
+	return (entry_rows[matching], positions[matching], src_rows.data[matching])
+
+def max_weights(weights, src_ids, trg_ids):
+	# Maximal weight of every source word over the sorted unique target
+	# word ids, None where the source word has no weight for any of them.
+	rows, _, values = match_rows(weights, src_ids, trg_ids)
+
+	src_max_weights = numpy.full(len(src_ids), -numpy.inf)
+	numpy.maximum.at(src_max_weights, rows, values)
+
+	return [None if weight == -numpy.inf else weight for weight in src_max_weights.tolist()]
+
+def calc_max_weights(weights, src_ids, trg_ids):
+	# Maximal weights by the distinct source word ids over the target words,
+	# None if there is no weight. A word without a weight of its own is
+	# considered to be translated by itself with the weight 1.
+	src_unique_ids, trg_unique_ids = numpy.unique(src_ids), numpy.unique(trg_ids)
+	src_known_ids = src_unique_ids[src_unique_ids >= 0]
+
+	src_max_weights = dict.fromkeys(src_unique_ids.tolist())
+	known_weights = max_weights(weights, src_known_ids, trg_unique_ids[trg_unique_ids >= 0])
+	src_max_weights.update(zip(src_known_ids.tolist(), known_weights))
+
+	for word_id in numpy.intersect1d(src_unique_ids, trg_unique_ids).tolist():
+		if lookup(weights, word_id, word_id): continue
+		src_max_weights[word_id] = max(1., src_max_weights[word_id])
+
+	return src_max_weights
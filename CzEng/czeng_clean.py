@@ -9,12 +9,21 @@ import time
 import tempfile
 import shutil
 import re
+import json
+import itertools
+
+import ordered_pool
 
 
 logger_freq = 2
 logger_timestamp = time.time()
 logger = logging.getLogger(__file__)
 
+worker_min_tokens = None
+worker_max_tokens = None
+
+no_letter_regex = re.compile(r'^[\W\d_]*$', re.UNICODE)
+
 def log_major(message):
 	global logger_timestamp
 	
@@ -42,28 +51,14 @@ def czeng_file_iter(czeng_file):
 
 		yield((id_, probab, cs_text, en_text))
 
-def czeng_clean(czeng_file, czeng_path, min_tokens, max_tokens):
-	# The tempfile.NamedTemporaryFile method helps to find the right name for the temporary file.
-	temp_file = tempfile.NamedTemporaryFile(prefix='czeng_clean.py_', dir=os.getcwd(), delete=True)
-	temp_path = temp_file.name
-	temp_file.close()
-
-	log_major("Cleaning document ...")
-
-	temp_file = codecs.open(temp_path, "w", "utf-8")
+def clean_block(block_item):
+	# Returns the kept lines of the block and the counts of the excluded ones.
+	block_index, lines = block_item
 
-	word_regex = re.compile(r'\b[^\W\d_]+\b', re.UNICODE)
-	no_letter_regex = re.compile(r'^[\W\d_]*$', re.UNICODE)
+	kept_lines = []
+	exclusions = {"too_few_tokens": 0, "too_many_tokens": 0, "no_letter_text": 0}
 
-	too_few_token_entries = 0
-	too_many_token_entries = 0
-	no_letter_text_entries = 0
-
-	line_index = 0
-	for id_, probab, cs_text, en_text in czeng_file_iter(czeng_file):
-
-		line_index += 1
-		log_minor("Cleaning line %s." % line_index)
+	for id_, probab, cs_text, en_text in czeng_file_iter(lines):
 
 		cs_tokens = len(en_text.split())
 		en_tokens = len(cs_text.split())
@@ -71,52 +66,125 @@ def czeng_clean(czeng_file, czeng_path, min_tokens, max_tokens):
 		cs_en_min_tokens = min(cs_tokens, en_tokens)
 		cs_en_max_tokens = max(cs_tokens, en_tokens)
 
-		if cs_en_min_tokens < min_tokens:
-			too_few_token_entries += 1
+		if cs_en_min_tokens < worker_min_tokens:
+			exclusions["too_few_tokens"] += 1
 			continue
 
-		if cs_en_max_tokens > max_tokens:
-			too_many_token_entries += 1
+		if cs_en_max_tokens > worker_max_tokens:
+			exclusions["too_many_tokens"] += 1
 			continue
 
 		if no_letter_regex.match(cs_text):
-			no_letter_text_entries += 1
+			exclusions["no_letter_text"] += 1
 			continue
 
 		if no_letter_regex.match(en_text):
-			no_letter_text_entries += 1
+			exclusions["no_letter_text"] += 1
 			continue
 
-		temp_file.write("%s\t%s\t%s\t%s\n" % (id_, probab, cs_text, en_text))
+		kept_lines.append("%s\t%s\t%s\t%s\n" % (id_, probab, cs_text, en_text))
+
+	return (block_index, len(lines), "".join(kept_lines), exclusions)
+
+def init_worker(min_tokens, max_tokens):
+	global worker_min_tokens, worker_max_tokens
+
+	worker_min_tokens = min_tokens
+	worker_max_tokens = max_tokens
+
+def block_iter(czeng_file, block_size):
+	block_index = 0
+	while True:
+
+		lines = list(itertools.islice(czeng_file, block_size))
+		if not lines: return
+
+		yield (block_index, lines)
+		block_index += 1
+
+def cleaned_block_iter(czeng_file, min_tokens, max_tokens, block_size, workers):
+	block_items = block_iter(czeng_file, block_size)
+	return ordered_pool.ordered_map(clean_block, block_items, workers, init_worker, (min_tokens, max_tokens))
+
+def open_output(czeng_path, output_path):
+	# Returns the file to write to and the path to move it to at the end, if
+	# any. The output is written to a temporary file first only if it would
+	# replace the input, "-" stands for the standard output.
+	if output_path == "-": return (codecs.getwriter("utf-8")(sys.stdout), None)
 
+	if output_path is not None and not (os.path.exists(output_path) and os.path.samefile(czeng_path, output_path)):
+		return (codecs.open(output_path, "w", "utf-8"), None)
+
+	# The tempfile.NamedTemporaryFile method helps to find the right name for the temporary file.
+	temp_file = tempfile.NamedTemporaryFile(prefix='czeng_clean.py_', dir=os.getcwd(), delete=True)
+	temp_path = temp_file.name
 	temp_file.close()
 
-	log_major("Excluding %s too-few-words entries." % too_few_token_entries)
-	log_major("Excluding %s too-many-words entries." % too_many_token_entries)
-	log_major("Excluding %s no-letter-text entries." % no_letter_text_entries)
+	return (codecs.open(temp_path, "w", "utf-8"), temp_path)
+
+def czeng_clean(czeng_file, czeng_path, min_tokens, max_tokens, output_path, report_path, block_size, workers):
+	log_major("Cleaning document ...")
+
+	output_file, temp_path = open_output(czeng_path, output_path)
+
+	report = {"entries": 0, "kept_entries": 0,
+		"too_few_tokens": 0, "too_many_tokens": 0, "no_letter_text": 0,
+		"min_tokens": min_tokens, "max_tokens": max_tokens}
+
+	try:
+		for block_index, block_lines, block_text, exclusions in cleaned_block_iter(czeng_file, min_tokens, max_tokens, block_size, workers):
+
+			report["entries"] += block_lines
+			log_minor("Cleaning line %s." % report["entries"])
+
+			output_file.write(block_text)
+			for name, count in exclusions.items(): report[name] += count
+	finally:
+		if output_path == "-": output_file.flush()
+		else: output_file.close()
+
+	report["kept_entries"] = report["entries"] - report["too_few_tokens"] - report["too_many_tokens"] - report["no_letter_text"]
+
+	log_major("Excluding %s too-few-words entries." % report["too_few_tokens"])
+	log_major("Excluding %s too-many-words entries." % report["too_many_tokens"])
+	log_major("Excluding %s no-letter-text entries." % report["no_letter_text"])
 
-	shutil.move(temp_path, czeng_path)
+	if report_path:
+		report_file = codecs.open(report_path, "w", "utf-8")
+		json.dump(report, report_file, indent=2, sort_keys=True)
+		report_file.write("\n")
+		report_file.close()
+
+	if temp_path: shutil.move(temp_path, czeng_path)
 
 	log_major("Document cleaned.")
 
 
 if __name__ == "__main__":
-	logging_format = '>>> [%(filename)s][%(asctime)s] %(message)s'
-	logging.basicConfig(stream=sys.stdout, format=logging_format, level=logging.INFO)
-
 	parser = argparse.ArgumentParser(prog=__file__, add_help=False)
 	parser.add_argument('-c', '--czeng', required=True, type=str)
 	parser.add_argument('-m', '--min_tokens', required=False, type=int, default=1)
 	parser.add_argument('-x', '--max_tokens', required=False, type=int, default=50)
+	parser.add_argument('-o', '--output', type=str, default=None)
+	parser.add_argument('-r', '--report', type=str, default=None)
+	parser.add_argument('-bs', '--block_size', type=int, default=100000)
+	parser.add_argument('-p', '--workers', type=int, default=1)
 	args = parser.parse_args()
 
+	# The log goes to the standard error output, if the cleaned document
+	# goes to the standard output.
+	logging_format = '>>> [%(filename)s][%(asctime)s] %(message)s'
+	logging_stream = sys.stderr if args.output == "-" else sys.stdout
+	logging.basicConfig(stream=logging_stream, format=logging_format, level=logging.INFO)
+
 	log_major("Starting execution in %s." % os.getcwd())
 	for arg in vars(args): log_major("Option --%s = %s." % (arg, getattr(args, arg)))
 
 	czeng_file = codecs.open(args.czeng, "r", "utf-8")
 
 	try:
-		czeng_clean(czeng_file, args.czeng, args.min_tokens, args.max_tokens)
+		czeng_clean(czeng_file, args.czeng, args.min_tokens, args.max_tokens,
+			args.output, args.report, args.block_size, args.workers)
 		log_major("Script ended successfully.")
 	except:
 		log_major("Script ended unsucessfully!")
@@ -6,12 +6,29 @@ import argparse
 import codecs
 import logging
 import time
+import tempfile
+import shutil
+
+import numpy
+
+import ordered_pool
 
 
 logger_freq = 2
 logger_timestamp = time.time()
 logger = logging.getLogger(__file__)
 
+# Input of at most this many bytes is counted by a worker at a time.
+range_bytes = 64 * 1024 * 1024
+
+worker_czeng_path = None
+worker_chunk_size = None
+worker_shard_path = None
+worker_cs_occus = None
+worker_en_occus = None
+worker_threshold = None
+worker_piece_size = None
+
 def log_major(message):
 	global logger_timestamp
 	
@@ -39,47 +56,339 @@ def czeng_file_iter(czeng_file):
 
 		yield((id_, probab, cs_text, en_text))
 
-def dice_czeng(czeng_file, output_file, threshold):
-	log_major("Examining document ...")
-
-	coocs, cs_occus, en_occus = {}, {}, {}
-
+def logged_line_iter(czeng_file):
 	line_index = 0
-	for _, _, cs_text, en_text in czeng_file_iter(czeng_file):
+	for line in czeng_file:
 
 		line_index += 1
 		log_minor("Examining line %s." % line_index)
 
-		cs_words = set(cs_text.split())
-		en_words = set(en_text.split())
+		yield line
+
+def file_ranges(czeng_path, range_count):
+	# Splits the file into about equal byte ranges, every one of them starts
+	# at the beginning of a line.
+	file_size = os.path.getsize(czeng_path)
+	czeng_file = open(czeng_path, "rb")
+
+	range_starts = [0]
+	for range_index in range(1, range_count):
+
+		range_start = file_size * range_index / range_count
+		if range_start <= range_starts[-1]: continue
+
+		# The line the byte before the start belongs to is skipped.
+		czeng_file.seek(range_start - 1)
+		czeng_file.readline()
+
+		range_start = czeng_file.tell()
+		if range_start > range_starts[-1] and range_start < file_size: range_starts.append(range_start)
+
+	czeng_file.close()
+
+	return zip(range_starts, range_starts[1:] + [file_size])
+
+def intern_words(words, word_ids, word_list, word_occus):
+	# Returns the ids of the words, new words get the next free id. Also
+	# counts the occurrence of every word.
+	ids = []
+	for word in words:
+
+		word_id = word_ids.get(word)
+		if word_id is None:
+			word_id = len(word_list)
+			word_ids[word] = word_id
+			word_list.append(word)
+			word_occus.append(0)
+
+		word_occus[word_id] += 1
+		ids.append(word_id)
+
+	return ids
+
+def merge_words(words, occus, word_ids, word_list, word_occus):
+	# Adds the words of a partial vocabulary with their occurrence counts,
+	# in the order of their partial ids. Returns the array mapping the
+	# partial ids to the ids.
+	ids = []
+	for word, occu in zip(words, occus):
+
+		word_id = word_ids.get(word)
+		if word_id is None:
+			word_id = len(word_list)
+			word_ids[word] = word_id
+			word_list.append(word)
+			word_occus.append(0)
+
+		word_occus[word_id] += occu
+		ids.append(word_id)
+
+	return numpy.array(ids, dtype=numpy.int64)
+
+def count_keys(keys):
+	# Distinct keys of the sorted keys and the count of every one of them.
+	if len(keys) == 0: return (keys, numpy.zeros(0, dtype=numpy.int64))
+
+	starts = numpy.flatnonzero(numpy.concatenate(([True], keys[1:] != keys[:-1])))
+	counts = numpy.diff(numpy.append(starts, len(keys)))
+	return (keys[starts], counts.astype(numpy.int64))
+
+def reduce_pairs(keys, counts):
+	# Sums the counts of equal keys, the distinct keys come out sorted.
+	if len(keys) == 0: return (keys, counts)
+
+	order = numpy.argsort(keys)
+	keys, counts = keys[order], counts[order]
+
+	starts = numpy.flatnonzero(numpy.concatenate(([True], keys[1:] != keys[:-1])))
+	return (keys[starts], numpy.add.reduceat(counts, starts))
+
+def shard_indices(keys, shards):
+	# Multiplicative hashing spreads the keys evenly over the shards, even
+	# though the ids of frequent words are all small.
+	hashes = keys.view(numpy.uint64) * numpy.uint64(0x9e3779b97f4a7c15)
+	return ((hashes >> numpy.uint64(32)) % numpy.uint64(shards)).astype(numpy.int64)
+
+def shard_prefix(shard_path, shard_index):
+	return os.path.join(shard_path, "shard_%04d" % shard_index)
+
+def create_pairs(shard_path, shards):
+	# Pair counts are kept in memory, or spilled to shards on the disk if
+	# there is a shard directory.
+	pairs = {"shard_path": shard_path, "shards": shards,
+		"keys": numpy.zeros(0, dtype=numpy.int64), "counts": numpy.zeros(0, dtype=numpy.int64),
+		"pending": [], "pending_length": 0}
+
+	for shard_index in range(shards if shard_path else 0):
+		prefix = shard_prefix(shard_path, shard_index)
+		open(prefix + ".keys", "wb").close()
+		open(prefix + ".counts", "wb").close()
+
+	return pairs
+
+def reduce_pending(pairs):
+	# Merges the pending chunks into the counted pairs by a single sort.
+	if not pairs["pending"]: return
+
+	keys = numpy.concatenate([pairs["keys"]] + [chunk_keys for chunk_keys, _ in pairs["pending"]])
+	counts = numpy.concatenate([pairs["counts"]] + [chunk_counts for _, chunk_counts in pairs["pending"]])
+
+	pairs["keys"], pairs["counts"] = reduce_pairs(keys, counts)
+	pairs["pending"], pairs["pending_length"] = [], 0
+
+def counted_pairs(pairs):
+	# Sorted distinct keys of the pairs kept in memory and their counts.
+	reduce_pending(pairs)
+	return (pairs["keys"], pairs["counts"])
+
+def flush_pairs(pairs, chunk_keys, chunk_counts):
+	# Adds sorted distinct keys and their counts to the pairs. In memory,
+	# the chunks are merged only once they are as many as the counted pairs,
+	# so every pair is sorted again only a logarithmic number of times. A
+	# shard receives the counts of its keys appended to its two files.
+	if not pairs["shard_path"]:
+		pairs["pending"].append((chunk_keys, chunk_counts))
+		pairs["pending_length"] += len(chunk_keys)
+
+		if pairs["pending_length"] >= len(pairs["keys"]): reduce_pending(pairs)
+		return
+
+	chunk_shards = shard_indices(chunk_keys, pairs["shards"])
+	order = numpy.argsort(chunk_shards, kind="mergesort")
+	bounds = numpy.append(0, numpy.cumsum(numpy.bincount(chunk_shards, minlength=pairs["shards"])))
+
+	for shard_index in range(pairs["shards"]):
+
+		shard_order = order[bounds[shard_index]:bounds[shard_index + 1]]
+		if len(shard_order) == 0: continue
+
+		prefix = shard_prefix(pairs["shard_path"], shard_index)
+		keys_file, counts_file = open(prefix + ".keys", "ab"), open(prefix + ".counts", "ab")
 
-		for cs_word in cs_words:
-			cs_occus[cs_word] = cs_occus.get(cs_word, 0) + 1
+		chunk_keys[shard_order].tofile(keys_file)
+		chunk_counts[shard_order].tofile(counts_file)
 
-		for en_word in en_words:
-			en_occus[en_word] = en_occus.get(en_word, 0) + 1
+		keys_file.close()
+		counts_file.close()
 
-		for cs_word in cs_words:
-			cs_word_coocs = coocs.get(cs_word, {})
-			coocs[cs_word] = cs_word_coocs
+def select_pairs(pair_keys, pair_counts, cs_occus, en_occus, threshold):
+	# Returns the keys of the pairs with Dice above the threshold and their Dice.
+	pair_occus = cs_occus[pair_keys >> 32] + en_occus[pair_keys & 0xffffffff]
+	dices = (2. * pair_counts) / pair_occus
 
-			for en_word in en_words:
-				cs_word_coocs[en_word] = cs_word_coocs.get(en_word, 0) + 1
+	selected = numpy.flatnonzero(dices > threshold)
+	return (pair_keys[selected], dices[selected])
 
-	log_major("Document examined.")
-	log_major("Outputting results.")
+def count_pairs(czeng_lines, cs_vocab, en_vocab, pairs, chunk_size):
+	# Every vocabulary is a (word_ids, word_list, word_occus) triple.
+	chunk_keys, chunk_length = [], 0
 
-	for cs_word, cs_word_coocs in coocs.items():
-		cs_word_occu = cs_occus.get(cs_word, 0)
+	for _, _, cs_text, en_text in czeng_file_iter(czeng_lines):
 
-		for en_word, cooc in cs_word_coocs.items():
-			en_word_occu = en_occus.get(en_word, 0)
-			dice = (2. * cooc) / (cs_word_occu + en_word_occu)
+		sent_cs_ids = intern_words(set(cs_text.split()), *cs_vocab)
+		sent_en_ids = intern_words(set(en_text.split()), *en_vocab)
 
-			if dice > threshold:
-				output_file.write("%s\t%s\t%s\n" % (cs_word, en_word, dice))
+		sent_cs_ids = numpy.array(sent_cs_ids, dtype=numpy.int64) << 32
+		sent_en_ids = numpy.array(sent_en_ids, dtype=numpy.int64)
 
-	log_major("Results outputted.")
+		chunk_keys.append((sent_cs_ids[:, numpy.newaxis] | sent_en_ids).ravel())
+		chunk_length += len(chunk_keys[-1])
+
+		if chunk_length >= chunk_size:
+			flush_pairs(pairs, *count_keys(numpy.sort(numpy.concatenate(chunk_keys))))
+			chunk_keys, chunk_length = [], 0
+
+	if chunk_keys: flush_pairs(pairs, *count_keys(numpy.sort(numpy.concatenate(chunk_keys))))
+
+def init_count_worker(czeng_path, chunk_size):
+	global worker_czeng_path, worker_chunk_size
+
+	worker_czeng_path = czeng_path
+	worker_chunk_size = chunk_size
+
+def count_range(byte_range):
+	# Counts the lines of the byte range with vocabularies of its own.
+	range_start, range_end = byte_range
+
+	czeng_file = open(worker_czeng_path, "rb")
+	czeng_file.seek(range_start)
+	range_text = czeng_file.read(range_end - range_start).decode("utf-8")
+	czeng_file.close()
+
+	cs_vocab, en_vocab = ({}, [], []), ({}, [], [])
+	pairs = create_pairs(None, 0)
+	count_pairs(range_text.splitlines(True), cs_vocab, en_vocab, pairs, worker_chunk_size)
+
+	return (cs_vocab[1:], en_vocab[1:]) + counted_pairs(pairs)
+
+def counted_range_iter(czeng_path, chunk_size, workers, range_size):
+	byte_ranges = file_ranges(czeng_path, max(4 * workers, os.path.getsize(czeng_path) / range_size + 1))
+
+	# Results come in the order of the file.
+	return ordered_pool.ordered_map(count_range, byte_ranges, workers, init_count_worker, (czeng_path, chunk_size))
+
+def merge_ranges(czeng_path, cs_vocab, en_vocab, pairs, chunk_size, workers, range_size):
+	# Partial vocabularies are merged in the order of the file, so every word
+	# gets the same id as in a serial run, and the partial pair keys are
+	# mapped to those ids.
+	range_index = 0
+	for range_cs_vocab, range_en_vocab, range_keys, range_counts in counted_range_iter(czeng_path, chunk_size, workers, range_size):
+
+		range_index += 1
+		log_minor("Merging range %s." % range_index)
+
+		cs_id_map = merge_words(*(range_cs_vocab + cs_vocab))
+		en_id_map = merge_words(*(range_en_vocab + en_vocab))
+
+		range_keys = (cs_id_map[range_keys >> 32] << 32) | en_id_map[range_keys & 0xffffffff]
+		flush_pairs(pairs, *reduce_pairs(range_keys, range_counts))
+
+def init_shard_worker(shard_path, cs_occus, en_occus, threshold, piece_size):
+	# Workers are forked, so the occurrence counts are passed without pickling.
+	global worker_shard_path, worker_cs_occus, worker_en_occus, worker_threshold, worker_piece_size
+
+	worker_shard_path = shard_path
+	worker_cs_occus = cs_occus
+	worker_en_occus = en_occus
+	worker_threshold = threshold
+	worker_piece_size = piece_size
+
+def dice_shard(shard_index):
+	# A shard is read in pieces of piece_size pairs, so that only its distinct
+	# pairs and the pieces pending to be merged into them are in memory.
+	prefix = shard_prefix(worker_shard_path, shard_index)
+	keys_file, counts_file = open(prefix + ".keys", "rb"), open(prefix + ".counts", "rb")
+
+	pairs = create_pairs(None, 0)
+
+	try:
+		while True:
+
+			piece_keys = numpy.fromfile(keys_file, dtype=numpy.int64, count=worker_piece_size)
+			piece_counts = numpy.fromfile(counts_file, dtype=numpy.int64, count=worker_piece_size)
+			if len(piece_keys) == 0: break
+
+			flush_pairs(pairs, *reduce_pairs(piece_keys, piece_counts))
+	finally:
+		keys_file.close()
+		counts_file.close()
+
+	os.remove(prefix + ".keys")
+	os.remove(prefix + ".counts")
+
+	pair_keys, pair_counts = counted_pairs(pairs)
+	return select_pairs(pair_keys, pair_counts, worker_cs_occus, worker_en_occus, worker_threshold)
+
+def dice_shards(pairs, cs_occus, en_occus, threshold, piece_size, workers):
+	# The shards share no keys, so they are reduced independently and their
+	# selected pairs are joined and sorted as if they were never sharded.
+	init_args = (pairs["shard_path"], cs_occus, en_occus, threshold, piece_size)
+	shard_list = range(pairs["shards"])
+	shard_results = list(ordered_pool.ordered_map(dice_shard, shard_list, workers, init_shard_worker, init_args))
+
+	pair_keys = numpy.concatenate([keys for keys, _ in shard_results])
+	dices = numpy.concatenate([dices for _, dices in shard_results])
+
+	order = numpy.argsort(pair_keys)
+	return (pair_keys[order], dices[order])
+
+def dice_czeng(czeng_path, output_file, threshold, chunk_size, memory_limit, shards, workers):
+	# Words are interned to integer ids and every co-occurring pair of ids
+	# is encoded as a single int64 key, cs_id << 32 | en_id. Keys of the
+	# recent sentences are buffered and, once there are chunk_size of them,
+	# counted and added to the pairs. With more workers, byte ranges of the
+	# file are counted in parallel and their partial counts are merged.
+	#
+	# With a memory limit (in megabytes), the pairs are spilled to shards
+	# in a temporary directory instead and the buffers are sized to fit the
+	# limit. The distinct pairs of a single shard have to fit as well, so
+	# larger corpora need more shards.
+	shard_path, range_size = None, range_bytes
+	if memory_limit:
+		shard_path = tempfile.mkdtemp(prefix='czeng_dice.py_', dir=os.getcwd())
+
+		# Every buffered key takes about 48 bytes while being counted and
+		# every pair of a shard piece about 64 bytes while being reduced.
+		# A byte of the input makes about one pair.
+		memory_bytes = memory_limit * 1024 * 1024
+		chunk_size = max(1, memory_bytes / (48 * max(1, workers)))
+		piece_size = max(1, memory_bytes / (64 * max(1, workers)))
+		range_size = max(1, min(range_bytes, memory_bytes / (64 * 3 * max(1, workers))))
+
+	try:
+		log_major("Examining document ...")
+
+		cs_vocab, en_vocab = ({}, [], []), ({}, [], [])
+		pairs = create_pairs(shard_path, shards)
+
+		if workers <= 1:
+			czeng_file = codecs.open(czeng_path, "r", "utf-8")
+			count_pairs(logged_line_iter(czeng_file), cs_vocab, en_vocab, pairs, chunk_size)
+			czeng_file.close()
+		else:
+			merge_ranges(czeng_path, cs_vocab, en_vocab, pairs, chunk_size, workers, range_size)
+
+		cs_words, cs_occus = cs_vocab[1:]
+		en_words, en_occus = en_vocab[1:]
+
+		log_major("Document examined.")
+		log_major("Outputting results.")
+
+		cs_occus = numpy.array(cs_occus, dtype=numpy.int64)
+		en_occus = numpy.array(en_occus, dtype=numpy.int64)
+
+		if shard_path:
+			pair_keys, dices = dice_shards(pairs, cs_occus, en_occus, threshold, piece_size, workers)
+		else:
+			pair_keys, pair_counts = counted_pairs(pairs)
+			pair_keys, dices = select_pairs(pair_keys, pair_counts, cs_occus, en_occus, threshold)
+
+		for pair_key, dice in zip(pair_keys.tolist(), dices.tolist()):
+			output_file.write("%s\t%s\t%s\n" % (cs_words[pair_key >> 32], en_words[pair_key & 0xffffffff], dice))
+
+		log_major("Results outputted.")
+	finally:
+		if shard_path: shutil.rmtree(shard_path)
 
 
 if __name__ == "__main__":
@@ -90,19 +399,22 @@ if __name__ == "__main__":
 	parser.add_argument('-c', '--czeng', required=True, type=str)
 	parser.add_argument('-o', '--output', required=True, type=str)
 	parser.add_argument('-t', '--threshold', type=float, default=0.1)
+	parser.add_argument('-ch', '--chunk_size', type=int, default=10000000)
+	parser.add_argument('-ml', '--memory_limit', type=int, default=None)
+	parser.add_argument('-sh', '--shards', type=int, default=64)
+	parser.add_argument('-p', '--workers', type=int, default=1)
 	args = parser.parse_args()
 
 	log_major("Starting execution in %s." % os.getcwd())
 	for arg in vars(args): log_major("Option --%s = %s." % (arg, getattr(args, arg)))
 
-	czeng_file = codecs.open(args.czeng, "r", "utf-8")
 	output_file = codecs.open(args.output, "w", "utf-8")
 
 	try:
-		dice_czeng(czeng_file, output_file, args.threshold)
+		dice_czeng(args.czeng, output_file, args.threshold, args.chunk_size,
+			args.memory_limit, args.shards, args.workers)
 		log_major("Script ended successfully.")
 	except:
 		log_major("Script ended unsucessfully!")
 	finally:
-		czeng_file.close()
 		output_file.close()
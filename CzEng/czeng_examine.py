@@ -6,8 +6,7 @@ import argparse
 import codecs
 import logging
 import time
-
-import scipy.stats as stats
+import math
 
 
 logger_freq = 2
@@ -41,10 +40,99 @@ def czeng_file_iter(czeng_file):
 
 		yield((id_, probab, cs_text, en_text))
 
-def examine_czeng(czeng_file):
+def create_moments():
+	return {"count": 0, "mean": 0., "m2": 0., "min": float("inf"), "max": float("-inf")}
+
+def update_moments(moments, value):
+	# Welford's algorithm, numerically stable in a single pass.
+	moments["count"] += 1
+	delta = value - moments["mean"]
+	moments["mean"] += delta / moments["count"]
+	moments["m2"] += delta * (value - moments["mean"])
+
+	moments["min"] = min(moments["min"], value)
+	moments["max"] = max(moments["max"], value)
+
+def moments_sd(moments):
+	# Maximum likelihood estimate, the same as scipy.stats.norm.fit gives.
+	if moments["count"] == 0: return float("nan")
+	return math.sqrt(moments["m2"] / moments["count"])
+
+def create_quantile(probab):
+	# P-square estimate of a quantile, five markers in constant memory.
+	# http://www.cse.wustl.edu/~jain/papers/ftp/psqr.pdf
+	return {"probab": probab, "heights": [], "positions": [1, 2, 3, 4, 5],
+		"desired": [1., 1. + 2. * probab, 1. + 4. * probab, 3. + 2. * probab, 5.],
+		"increments": [0., probab / 2., probab, (1. + probab) / 2., 1.]}
+
+def update_quantile(quantile, value):
+	heights, positions, desired = quantile["heights"], quantile["positions"], quantile["desired"]
+
+	if len(heights) < 5:
+		heights.append(value)
+		heights.sort()
+		return
+
+	if value < heights[0]:
+		heights[0] = value
+		cell = 0
+	elif value >= heights[4]:
+		heights[4] = value
+		cell = 3
+	else:
+		cell = max(index for index in range(4) if heights[index] <= value)
+
+	for index in range(cell + 1, 5): positions[index] += 1
+	for index in range(5): desired[index] += quantile["increments"][index]
+
+	for index in range(1, 4):
+
+		shift = desired[index] - positions[index]
+		if not ((shift >= 1. and positions[index + 1] - positions[index] > 1) or
+			(shift <= -1. and positions[index - 1] - positions[index] < -1)): continue
+
+		step = 1 if shift > 0. else -1
+		height = parabolic_height(heights, positions, index, step)
+
+		if not heights[index - 1] < height < heights[index + 1]:
+			height = heights[index] + step * (heights[index + step] - heights[index]) / float(positions[index + step] - positions[index])
+
+		heights[index] = height
+		positions[index] += step
+
+def parabolic_height(heights, positions, index, step):
+	lower_width = float(positions[index] - positions[index - 1])
+	upper_width = float(positions[index + 1] - positions[index])
+
+	return heights[index] + step / (lower_width + upper_width) * (
+		(lower_width + step) * (heights[index + 1] - heights[index]) / upper_width +
+		(upper_width - step) * (heights[index] - heights[index - 1]) / lower_width)
+
+def quantile_value(quantile):
+	heights = quantile["heights"]
+	if not heights: return float("nan")
+
+	# Fewer than five values are still kept, so the quantile is exact.
+	if len(heights) < 5: return heights[int(round(quantile["probab"] * (len(heights) - 1)))]
+	return heights[2]
+
+def create_histogram(bins, max_value):
+	# Equal bins over [0, max_value), values out of the range are counted apart.
+	return {"bins": [0] * bins, "max": max_value, "under": 0, "over": 0}
+
+def update_histogram(histogram, value):
+	if value < 0.: histogram["under"] += 1
+	elif value >= histogram["max"]: histogram["over"] += 1
+	else: histogram["bins"][int(value / histogram["max"] * len(histogram["bins"]))] += 1
+
+def examine_czeng(czeng_file, quantile_probabs, histogram_bins, histogram_max):
+	# The statistics of the EN / CS length ratios are computed on the fly,
+	# so the memory does not grow with the document.
 	log_major("Examining document ...")
 
-	en_cs_len_ratios = []
+	moments = create_moments()
+	quantiles = [create_quantile(probab) for probab in quantile_probabs]
+	histogram = create_histogram(histogram_bins, histogram_max) if histogram_bins > 0 else None
 
 	line_index = 0
 	for _, _, cs_text, en_text in czeng_file_iter(czeng_file):
@@ -54,14 +142,31 @@ def examine_czeng(czeng_file):
 
 		en_len = float(len(en_text))
 		cs_len = float(len(cs_text))
-		en_cs_len_ratios.append(en_len / cs_len)
+		en_cs_len_ratio = en_len / cs_len
+
+		update_moments(moments, en_cs_len_ratio)
+		for quantile in quantiles: update_quantile(quantile, en_cs_len_ratio)
+		if histogram: update_histogram(histogram, en_cs_len_ratio)
 
 	log_major("Document examined.")
 	log_major("Logging results.")
 
-	en_cs_len_ratio_mean, en_cs_len_ratio_sd = stats.norm.fit(en_cs_len_ratios)
-	log_major("Mean of EN / CS length ratio: %s." % en_cs_len_ratio_mean)
-	log_major("Sigma of EN / CS length ratio: %s." % en_cs_len_ratio_sd)
+	en_cs_len_ratio_mean, en_cs_len_ratio_sd = moments["mean"], moments_sd(moments)
+	log_major("Mean of EN / CS length ratio: %r." % en_cs_len_ratio_mean)
+	log_major("Sigma of EN / CS length ratio: %r." % en_cs_len_ratio_sd)
+	log_major("Minimum and maximum of EN / CS length ratio: %s, %s." % (moments["min"], moments["max"]))
+
+	for quantile in quantiles:
+		log_major("Quantile %s of EN / CS length ratio: %s." % (quantile["probab"], quantile_value(quantile)))
+
+	if histogram:
+		bin_width = histogram["max"] / len(histogram["bins"])
+		log_major("Histogram of EN / CS length ratio (-inf, %.3f): %s." % (0., histogram["under"]))
+		for bin_index, count in enumerate(histogram["bins"]):
+			log_major("Histogram of EN / CS length ratio [%.3f, %.3f): %s." % (bin_index * bin_width, (bin_index + 1) * bin_width, count))
+		log_major("Histogram of EN / CS length ratio [%.3f, inf): %s." % (histogram["max"], histogram["over"]))
+
+	log_major("Options of score_align.py and the classifiers: -m %r -d %r." % (en_cs_len_ratio_mean, en_cs_len_ratio_sd))
 
 	log_major("Results logged.")
 
@@ -72,6 +177,9 @@ if __name__ == "__main__":
 
 	parser = argparse.ArgumentParser(prog=__file__, add_help=False)
 	parser.add_argument('-c', '--czeng', required=True, type=str)
+	parser.add_argument('-q', '--quantiles', type=str, default="")
+	parser.add_argument('-hb', '--histogram_bins', type=int, default=0)
+	parser.add_argument('-hx', '--histogram_max', type=float, default=3.)
 	args = parser.parse_args()
 
 	log_major("Starting execution in %s." % os.getcwd())
@@ -79,7 +187,8 @@ if __name__ == "__main__":
 
 	try:
 		czeng_file = codecs.open(args.czeng, "r", "utf-8")
-		examine_czeng(czeng_file)
+		quantile_probabs = [float(probab) for probab in args.quantiles.split(",") if probab]
+		examine_czeng(czeng_file, quantile_probabs, args.histogram_bins, args.histogram_max)
 		log_major("Script ended successfully.")
 	except:
 		log_major("Script ended unsucessfully!")
@@ -0,0 +1,36 @@
+import collections
+import multiprocessing
+
+
+# Ordered, bounded parallel map of the stages that process blocks or byte
+# ranges in worker processes, the same as Align/ordered_pool.py so that the
+# CzEng scripts do not depend on the Align directory. Items are submitted
+# only a few ahead of the consumed results, which keeps the memory bounded,
+# and the results are yielded in the order of the items. Workers are
+# forked, so whatever init_worker stores in module globals, e.g. the
+# memory-mapped tables, is inherited rather than pickled for every item.
+
+def ordered_map(function, items, workers, init_worker=None, init_args=()):
+	if workers <= 1:
+		if init_worker: init_worker(*init_args)
+
+		for item in items:
+			yield function(item)
+
+		return
+
+	pool = multiprocessing.Pool(workers, init_worker, init_args)
+	pending = collections.deque()
+
+	try:
+		for item in items:
+
+			pending.append(pool.apply_async(function, (item,)))
+			if len(pending) > 2 * workers: yield pending.popleft().get()
+
+		while pending: yield pending.popleft().get()
+
+		pool.close()
+	finally:
+		pool.terminate()
+		pool.join()